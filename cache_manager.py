@@ -0,0 +1,479 @@
+#!/bin/python
+
+import os
+import re
+import fcntl
+import hashlib
+import numpy as np
+import ROOT
+
+from fp_utils import *
+from file_manager import getHistoFiles
+
+###---cache location--------------------------------------------------
+def getCacheDir(cfg=None):
+    """
+    Return the FP cache directory (created if missing):
+    draw.cacheDir if specified, otherwise $FP_CACHE_DIR or ~/.cache/furiousplotter
+    """
+
+    if cfg and cfg.OptExist("draw.cacheDir"):
+        path = expand_path(str(cfg.GetOpt("draw.cacheDir")))
+    else:
+        path = os.environ.get("FP_CACHE_DIR", os.path.expanduser("~/.cache/furiousplotter"))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    return path
+
+###---text sources binary cache---------------------------------------
+def getTextCacheKey(path, branch_desc):
+    """
+    Return the key identifying the cached conversion of a text source: the file path,
+    size and modification time together with the branch descriptor
+    """
+
+    stat = os.stat(path)
+    key = "|".join([os.path.abspath(path), str(stat.st_size), str(stat.st_mtime), str(branch_desc)])
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def getTextCache(path, branch_desc, cache_dir):
+    """
+    Return the path of the ROOT file holding the TTree (fp_text) read from a text source.
+    The text file is parsed with TTree::ReadFile and stored (LZ4 compressed) only if
+    the cache does not exist yet.
+    """
+
+    cache_path = os.path.join(cache_dir, "text_"+getTextCacheKey(path, branch_desc)+".root")
+    if not os.path.isfile(cache_path):
+        printMessage("Caching text source <"+colors.CYAN+path+colors.DEFAULT+">", 0)
+        curdir = ROOT.gDirectory.CurrentDirectory().load()
+        #---write to a temporary file first: concurrent runs never see a partial cache
+        tmp_path = cache_path.replace(".root", "_"+str(os.getpid())+".root")
+        cache_file = ROOT.TFile.Open(tmp_path, "RECREATE", "", 404)
+        tree = ROOT.TTree("fp_text", path)
+        tree.ReadFile(path, branch_desc)
+        tree.Write()
+        cache_file.Close()
+        os.rename(tmp_path, cache_path)
+        curdir.cd()
+
+    return cache_path
+
+###---parsed configuration cache----------------------------------------
+def getCfgFiles(path, files=None):
+    """
+    Return the configuration file and all the files it includes through importCfg (recursively).
+    Relative paths are resolved from the current directory first, then from the including file directory.
+    Returns None if an included file cannot be found.
+    """
+
+    files = [] if files is None else files
+    path = os.path.abspath(expand_path(path))
+    if path in files:
+        return files
+    if not os.path.isfile(path):
+        return None
+    files.append(path)
+    with open(path) as cfg_file:
+        for line in cfg_file:
+            line = line.split("#")[0]
+            if "importCfg" not in line:
+                continue
+            for included in line[line.index("importCfg")+len("importCfg"):].split():
+                if not os.path.isfile(expand_path(included)):
+                    included = os.path.join(os.path.dirname(path), included)
+                if getCfgFiles(included, files) is None:
+                    return None
+
+    return files
+
+def getCfgCacheKey(presets, cfg_path, mods):
+    """
+    Return the key identifying a parsed configuration: content hash of the main cfg and of the files
+    it imports together with the preset and modifier strings (None if the key cannot be computed).
+    Presets and modifiers importing files are not cached.
+    """
+
+    if any("importCfg" in string for string in presets+mods):
+        return None
+    key = hashlib.sha1("|".join(["preset:"+preset for preset in presets]+["mod:"+mod for mod in mods]).encode())
+    if cfg_path != "":
+        files = getCfgFiles(cfg_path)
+        if files is None:
+            return None
+        for path in files:
+            with open(path, 'rb') as cfg_file:
+                key.update((path+":"+hashlib.sha1(cfg_file.read()).hexdigest()).encode())
+
+    return key.hexdigest()
+
+def loadCfgCache(cfg_key, cache_dir):
+    """
+    Return the cached configuration (None if not available)
+    """
+
+    cache_path = os.path.join(cache_dir, "cfg_"+cfg_key+".root")
+    if not os.path.isfile(cache_path):
+        return None
+    curdir = ROOT.gDirectory.CurrentDirectory().load()
+    cache_file = ROOT.TFile.Open(cache_path)
+    cfg = cache_file.Get("cfg") if cache_file and not cache_file.IsZombie() else None
+    if cfg:
+        ROOT.SetOwnership(cfg, True)
+    if cache_file:
+        cache_file.Close()
+    curdir.cd()
+
+    return cfg if cfg else None
+
+def storeCfgCache(cfg, cfg_key, cache_dir):
+    """
+    Store the fully resolved configuration
+    """
+
+    cache_path = os.path.join(cache_dir, "cfg_"+cfg_key+".root")
+    curdir = ROOT.gDirectory.CurrentDirectory().load()
+    #---write to a temporary file first: concurrent runs never see a partial cache
+    tmp_path = cache_path.replace(".root", "_"+str(os.getpid())+".root")
+    cache_file = ROOT.TFile.Open(tmp_path, "RECREATE")
+    cache_file.WriteObject(cfg, "cfg")
+    cache_file.Close()
+    os.rename(tmp_path, cache_path)
+    curdir.cd()
+
+###---compiled plugins cache----------------------------------------------
+def getPluginsCacheDir(cache_dir):
+    """
+    Return the directory of the compiled plugins for the current ROOT version
+    """
+
+    path = os.path.join(cache_dir, "plugins_"+re.sub(r'\W', '_', ROOT.gROOT.GetVersion()))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    return path
+
+def loadCachedLibrary(source, lib_path, lib_dir):
+    """
+    Load the library lib_path compiled with ACLiC from source, compiling it first if needed.
+    Concurrent runs sharing the cache are serialized by a lock file: the library is built by a single process.
+    Returns False if the source cannot be compiled (nothing is recorded, the next run tries again).
+    """
+
+    so_path = lib_path+"."+ROOT.gSystem.GetSoExt()
+    with open(lib_path+".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isfile(so_path) and ROOT.gSystem.Load(so_path) >= 0:
+            return True
+        #---a library that cannot be loaded (e.g. left by an interrupted build) is rebuilt
+        return bool(ROOT.gSystem.CompileMacro(source, "kfO" if os.path.isfile(so_path) else "kO", lib_path, lib_dir))
+
+def loadCachedMacro(macro, cache_dir):
+    """
+    Load a .C/.C+ plugin from a library compiled with ACLiC and stored in the plugins cache.
+    The library is keyed by the macro path and content: it is compiled only once, following runs just load it.
+    Macros that cannot be compiled are loaded through the interpreter.
+    """
+
+    source = expand_path(macro.rstrip("+"))
+    with open(source, 'rb') as macro_file:
+        key = hashlib.sha1((os.path.abspath(source)+":").encode()+macro_file.read()).hexdigest()
+    lib_dir = getPluginsCacheDir(cache_dir)
+    if not loadCachedLibrary(source, os.path.join(lib_dir, "fp_macro_"+key), lib_dir):
+        ROOT.gROOT.LoadMacro(macro)
+
+###---lines that can be compiled: calls to the ROOT globals and static setters, no declarations
+_cached_line = re.compile(r'^(g(Style|ROOT|System|Env)\s*->|(TGaxis|TColor|TStyle|TROOT|TSystem|TEnv)\s*::)\s*\w+\s*\([^;]*\)\s*;?$')
+
+def processCachedLines(lines, cache_dir):
+    """
+    Process the C++ line plugins in the order they are listed. Consecutive calls to the ROOT globals and
+    static setters (gStyle->SetOptStat(0), TGaxis::SetMaxDigits(3), ...) are run by a function compiled once
+    in the plugins cache (keyed by the lines content). Any other line (declarations, preprocessor and interpreter
+    commands) is processed by the interpreter, so that the names it declares are available to the following plugins.
+    """
+
+    block = []
+    for line in lines+[None]:
+        if line is not None and _cached_line.match(line.strip()):
+            block.append(line)
+            continue
+        if len(block):
+            processCachedBlock(block, cache_dir)
+            block = []
+        if line is not None:
+            processLines([line])
+
+def processCachedBlock(statements, cache_dir):
+    """
+    Run statements through a function compiled in the plugins cache, fall back to processLines if it cannot be compiled
+    """
+
+    key = hashlib.sha1("\n".join(statements).encode()).hexdigest()
+    lib_dir = getPluginsCacheDir(cache_dir)
+    fname = "fp_lines_"+key[:16]
+    source = os.path.join(lib_dir, fname+".C")
+    if not os.path.isfile(source):
+        with open(source+".tmp"+str(os.getpid()), 'w') as source_file:
+            source_file.write("#include \"TROOT.h\"\n#include \"TStyle.h\"\n#include \"TSystem.h\"\n#include \"TEnv.h\"\n"+
+                              "#include \"TColor.h\"\n#include \"TGaxis.h\"\n\nvoid "+fname+"()\n{\n"+
+                              "\n".join("    "+line.strip().rstrip(";")+";" for line in statements)+"\n}\n")
+        os.rename(source+".tmp"+str(os.getpid()), source)
+    if loadCachedLibrary(source, os.path.join(lib_dir, fname), lib_dir):
+        getattr(ROOT, fname)()
+    else:
+        processLines(statements)
+
+###---binning helpers---------------------------------------------------
+def getBinningSpec(cfg, histo_key):
+    """
+    Return a hashable description of the histogram binning for plain TH1F/TH2F binnings:
+    + ("fixed", nbins, min, max) from a 3 values bins option
+    + ("fixed2", nxbins, xmin, xmax, nybins, ymin, ymax) from a 6 values bins option
+    + ("var", edges) from a single dbins option
+    None is returned for any other binning (profiles, 3D, 2D variable binnings).
+    """
+
+    try:
+        if cfg.OptExist(histo_key+".bins"):
+            bins = [str(value) for value in cfg.GetVOpt(histo_key+".bins")]
+            if len(bins) == 3:
+                return ("fixed", eval_i(bins[0]), eval_f(bins[1]), eval_f(bins[2]))
+            elif len(bins) == 6:
+                return ("fixed2", eval_i(bins[0]), eval_f(bins[1]), eval_f(bins[2]), eval_i(bins[3]), eval_f(bins[4]), eval_f(bins[5]))
+        elif cfg.OptExist(histo_key+".dbins"):
+            dbins = cfg.GetVOpt(histo_key+".dbins")
+            if len(dbins) == 1 and cfg.OptExist(dbins[0]):
+                return ("var", tuple(float(value) for value in cfg.GetVDoubleOpt(dbins[0])))
+    except (ValueError, NameError, SyntaxError):
+        return None
+
+    return None
+
+def getSpecEdges(spec):
+    """
+    Return the bin edges of a 1D binning spec
+    """
+
+    if spec[0] == "fixed":
+        return np.linspace(spec[2], spec[3], spec[1]+1)
+
+    return np.array(spec[1])
+
+def getSpecNbins(spec):
+    return spec[1]*spec[4] if spec[0] == "fixed2" else len(getSpecEdges(spec))-1
+
+def isCompatibleBinning(spec, fine):
+    """
+    Check if a histogram with binning spec can be obtained rebinning a histogram with binning fine:
+    + fixed size bins (1D and 2D): same binning type, same range and divisible number of bins
+    + variable bins: bin edges subset of the fine ones
+    """
+
+    if spec[0] in ("fixed", "fixed2") or fine[0] == "fixed2":
+        if spec[0] != fine[0]:
+            return False
+        if spec[0] == "fixed":
+            return spec[2:4] == fine[2:4] and fine[1] % spec[1] == 0
+        return spec[2:4] == fine[2:4] and spec[5:7] == fine[5:7] and fine[1] % spec[1] == 0 and fine[4] % spec[4] == 0
+    #---edges are matched within a small fraction of the narrowest fine bin
+    fine_edges = getSpecEdges(fine)
+    tolerance = 1e-6*np.diff(fine_edges).min() if len(fine_edges) > 1 else 0.
+
+    return bool(np.isclose(getSpecEdges(spec)[:, None], fine_edges[None, :], rtol=0, atol=tolerance).any(axis=1).all())
+
+def getPreviewKey(cfg):
+    """
+    Return the preview settings of a configuration: fills and results are shared only between configurations
+    reading the same entries
+    """
+
+    return tuple(str(cfg.GetOpt(opt)) if cfg.OptExist(opt) else "" for opt in ["draw.preview", "draw.maxEntries"])
+
+def getFillKey(cfg, histo_key, path, tree):
+    """
+    Return the key identifying a fill: tree (file path and name), variable, selection and preview settings
+    """
+
+    cut = "".join(str(value) for value in cfg.GetVOpt(histo_key+".cut")) if cfg.OptExist(histo_key+".cut") else ""
+
+    return (path, tree.split("/")[-1], str(cfg.GetOpt(histo_key+".var")), cut, getPreviewKey(cfg))
+
+###---histogram definitions-----------------------------------------------
+_definition_opts = ["src", "var", "cut", "bins", "dbins", "sparse", "sparseProjection", "operation", "textChunkSize"]
+
+def getDefinitionKey(cfg, histo_key):
+    """
+    Return the resolved definition of a histogram: the options that determine its content
+    (style options like customize, legendEntry and drawOptions are excluded).
+    Sources that are themselves histogram definitions are replaced by their own definition,
+    files by their absolute path. The preview settings are part of the definition.
+    """
+
+    definition = [("preview", getPreviewKey(cfg))]
+    for opt in _definition_opts:
+        if not cfg.OptExist(histo_key+"."+opt):
+            continue
+        values = []
+        for value in cfg.GetVOpt(histo_key+"."+opt):
+            value = str(value)
+            if opt == "src":
+                alias, src = value.split(":", 1) if ":" in value else ("", value)
+                if src != histo_key and cfg.OptExist(src+".src"):
+                    value = (alias, getDefinitionKey(cfg, src))
+                elif os.path.isfile(expand_path(src)):
+                    value = (alias, expand_path(src))
+            values.append(value)
+        definition.append((opt, tuple(values)))
+
+    return tuple(definition)
+
+###---run level cache--------------------------------------------------
+class FPRunCache:
+    """
+    Objects shared by all the plots of a run (all the configurations of a session):
+    + histograms of the same tree, var and cut with compatible binnings are derived from a single
+      fill at the finest binning (fine histograms are dropped after their last use)
+    + histograms with the same definition are computed once, each plot gets a clone of the
+      result (results are dropped after their last use)
+    configs is the list of the configurations drawn with the plots of each one: [(cfg, plots_names)]
+    """
+
+    def __init__(self, configs):
+        self.fineSpecs = {}
+        self.derivable = {}
+        self.uses      = {}
+        self.fills     = {}
+        self.results   = {}
+        self.resultUses = {}
+        self.definitions = {}
+
+        #---count the histograms sharing the same definition (each histogram is processed once per plot)
+        owners = {}
+        for cfg, plots_names in configs:
+            for plot_name in plots_names:
+                plot_keys = set()
+                for histo_key in getHistoKeys(cfg, plot_name):
+                    plot_keys.add(histo_key)
+                    plot_keys |= set(src for src in getSourceNames(cfg, histo_key) if cfg.OptExist(src+".src"))
+                for histo_key in plot_keys:
+                    definition = getDefinitionKey(cfg, histo_key)
+                    self.resultUses[definition] = self.resultUses.get(definition, 0)+1
+                    self.definitions.setdefault(definition, histo_key)
+                    owners.setdefault(definition, cfg)
+
+        #---group binnings by tree, var and cut (each definition is filled only once)
+        groups = {}
+        for definition, histo_key in self.definitions.items():
+            cfg = owners[definition]
+            spec = getBinningSpec(cfg, histo_key)
+            if not spec or not cfg.OptExist(histo_key+".var") or \
+               (cfg.OptExist(histo_key+".sparse") and eval_b(cfg.GetOpt(histo_key+".sparse"))):
+                continue
+            for path, trees in getHistoFiles(cfg, histo_key).items():
+                for tree in trees:
+                    groups.setdefault(getFillKey(cfg, histo_key, path, tree), []).append(spec)
+
+        #---the finest binning of each group from which the most binnings can be derived is filled,
+        #   the compatible ones are derived from it
+        for fill_key, specs in groups.items():
+            fine = max(specs, key=lambda fine: (sum(isCompatibleBinning(spec, fine) for spec in specs), getSpecNbins(fine)))
+            derivable = [spec for spec in specs if isCompatibleBinning(spec, fine)]
+            if len(derivable) > 1:
+                self.fineSpecs[fill_key] = fine
+                self.derivable[fill_key] = set(derivable)
+                self.uses[fill_key] = len(derivable)
+
+    ###---fine fill plan------------------------------------------------
+    def getFinePlan(self, cfg, histo_obj, histo_key):
+        """
+        Return (fill key, fine binning spec, histogram binning spec) if the histogram can be derived
+        from a fine fill of the same tree, None otherwise
+        """
+
+        if histo_obj.ClassName() != "TTree" or not histo_obj.GetCurrentFile():
+            return None
+        fill_key = getFillKey(cfg, histo_key, histo_obj.GetCurrentFile().GetName(), histo_obj.GetName())
+        spec = getBinningSpec(cfg, histo_key)
+        if fill_key not in self.fineSpecs or spec not in self.derivable[fill_key]:
+            return None
+
+        return fill_key, self.fineSpecs[fill_key], spec
+
+    def getFill(self, fill_key):
+        return self.fills.get(fill_key, None)
+
+    def storeFill(self, fill_key, histo):
+        self.fills[fill_key] = histo
+
+    def useFill(self, fill_key):
+        """
+        Record one use of a fine histogram, drop it after its last use
+        """
+
+        self.uses[fill_key] -= 1
+        if self.uses[fill_key] <= 0 and fill_key in self.fills:
+            del self.fills[fill_key]
+
+    ###---histogram results----------------------------------------------
+    def getResultKey(self, cfg, histo_key):
+        """
+        Return the definition key of a histogram if the same definition is used more than once in the run
+        """
+
+        definition = getDefinitionKey(cfg, histo_key)
+
+        return definition if self.resultUses.get(definition, 0) > 1 else None
+
+    def getResult(self, result_key, name):
+        """
+        Return a clone of the stored result (None if not computed yet), drop the result after its last use
+        """
+
+        if result_key not in self.results:
+            return None
+        result = self.results[result_key].Clone(name)
+        self.resultUses[result_key] -= 1
+        if self.resultUses[result_key] <= 0:
+            del self.results[result_key]
+
+        return result
+
+    def storeResult(self, result_key, histo):
+        """
+        Store a detached copy of the result, the plot keeps the original (and can style it)
+        """
+
+        self.results[result_key] = histo.Clone(histo.GetName()+"_fp_result")
+        if "TGraph" not in self.results[result_key].ClassName() and "TF1" not in self.results[result_key].ClassName():
+            self.results[result_key].SetDirectory(0)
+        self.resultUses[result_key] -= 1
+
+    ###---memory management----------------------------------------------
+    def evict(self):
+        """
+        Drop all the cached objects (they are recomputed if needed again)
+        """
+
+        self.fills.clear()
+        self.results.clear()
+
+###---derive histogram from a fine fill----------------------------------
+def rebinFineHistogram(fine, fine_spec, spec, name):
+    """
+    Rebin the fine histogram to the binning described by spec
+    """
+
+    if spec[0] == "fixed2":
+        return fine.Rebin2D(fine_spec[1]//spec[1], fine_spec[4]//spec[4], name)
+    elif spec[0] == "fixed":
+        return fine.Rebin(fine_spec[1]//spec[1], name)
+
+    #---variable binning: use the matching fine edges to avoid rounding mismatches
+    fine_edges = getEdgesArray(fine.GetXaxis())
+    match = np.abs(getSpecEdges(spec)[:, None]-fine_edges[None, :]).argmin(axis=1)
+    edges = np.ascontiguousarray(fine_edges[match], dtype=np.float64)
+
+    return fine.Rebin(len(edges)-1, name, edges)
@@ -5,64 +5,365 @@ import re
 import time
 import argparse
 import os
-import copy
+import gc
+import hashlib
 import subprocess
 import importlib
+import shlex
 import ROOT
 import cfgmanager
 
 from fp_utils import *
 from plot_manager import *
 from tree_manager import *
+from file_manager import *
+from cache_manager import *
+from progress_manager import *
+from plan_manager import *
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch(True)
 ROOT.PyConfig.ShutDown = False
 
-def draw(cmd_opts=None):
+###---session class---------------------------------------------------
+class FPSession:
     """
-    FuriousPlotter main loop    
+    Resources shared by all the configurations drawn in the same process:
+    + python plugins, C++ macros and libraries (loaded only once)
+    + the pool of ROOT files (files read by the following configurations are kept open)
+    + the histogram cache: fills and results are shared by all the configurations
+    + the running write processes
+    Each configuration is parsed in its own CfgManager, the style is reset before drawing the next configuration.
     """
 
-    cfg = cfgmanager.CfgManager()
-    if cmd_opts.preset != "":
-        for preset in cmd_opts.preset.split(','):
+    def __init__(self):
+        self.loaded     = set()
+        self.filePool   = None
+        self.runCache   = None
+        self.writeProcs = []
+        self.journals   = []
+        self.cachedConfigs = []
+        #---create line object for drawing custom lines
+        ROOT.gROOT.ProcessLine("TLine line;")
+        ROOT.gROOT.ProcessLine("TLatex latex;")
+        self.style = ROOT.TStyle()
+        ROOT.gStyle.Copy(self.style)
+        sys.path.insert(1, os.getcwd())
+
+    ###---configuration--------------------------------------------------
+    def loadConfig(self, cfg_path="", presets=[], mods=[], use_cache=True):
+        """
+        Parse presets, cfg file and modifiers. The fully resolved cfg is cached, keyed by the content
+        of the cfg files and the modifiers. Configurations loaded from the cache are listed in cachedConfigs.
+        """
+
+        cfg_key = getCfgCacheKey(presets, cfg_path, mods) if use_cache else None
+        cfg = loadCfgCache(cfg_key, getCacheDir()) if cfg_key else None
+        if cfg:
+            self.cachedConfigs.append(cfg)
+            return cfg
+        cfg = cfgmanager.CfgManager()
+        for preset in presets:
             print(preset)
             cfg.ParseConfigString(preset)        
-    if cmd_opts.cfg != "":
-        cfg.ParseConfigFile(cmd_opts.cfg)
-    if cmd_opts.mod != "":
-        for config in cmd_opts.mod.split(','):
+        if cfg_path != "":
+            cfg.ParseConfigFile(cfg_path)
+        for config in mods:
             print(config)
             cfg.ParseConfigString(config)
+        if cfg_key:
+            storeCfgCache(cfg, cfg_key, getCacheDir())
+
+        return cfg
+
+    ###---plugins--------------------------------------------------------
+    def loadPlugins(self, cfg):
+        """
+        Load py/C++ plugins, proccess all lines before. Returns the operations available to the cfg.
+        Modules, macros and libraries already loaded in the session are not loaded again.
+        """
+
+        plugin_funcs = {}
+        plugins = {"py" : ['operations'], "C" : [], "so" : [], "line" : []}    
+        if cfg.OptExist("draw.plugins"):        
+            for plugin in cfg.GetVOpt("draw.plugins"):
+                plugin = str(plugin)
+                if ".py" == plugin[-3:]:
+                    plugins["py"].append(plugin[:-3])
+                elif ".C" == plugin[-2:] or ".C+" == plugin[-3:]:
+                    plugins["C"].append(plugin)
+                elif ".so" == plugin[-3:]:
+                    plugins["so"].append(plugin)
+                else:
+                    plugins["line"].append(plugin)
+        #---C++ plugins are compiled once and stored in the cache (draw.pluginCache false to disable)
+        plugin_cache = eval_b(cfg.GetOpt("draw.pluginCache")) if cfg.OptExist("draw.pluginCache") else True
+        if plugin_cache:
+            processCachedLines(plugins["line"], getCacheDir(cfg))
+        else:
+            processLines(plugins["line"])
+        for plugin in plugins["py"]:
+            plugin_module = importlib.import_module(plugin)
+            for func_name in getattr(plugin_module, 'FPOperations', []):
+                plugin_funcs[func_name] = getattr(plugin_module, func_name)
+            #---array operations: work on numpy arrays instead of ROOT objects
+            for func_name in getattr(plugin_module, 'FPArrayOperations', []):
+                plugin_funcs[func_name] = makeArrayOperation(getattr(plugin_module, func_name))
+        for macro in plugins["C"]:
+            if macro in self.loaded:
+                continue
+            if plugin_cache:
+                loadCachedMacro(macro, getCacheDir(cfg))
+            else:
+                ROOT.gROOT.LoadMacro(macro) 
+            self.loaded.add(macro)
+        for lib in plugins["so"]:
+            if lib not in self.loaded:
+                ROOT.gSystem.Load(lib) 
+                self.loaded.add(lib)
+
+        return plugin_funcs
+
+    ###---shared resources-----------------------------------------------
+    def openFilePool(self, cfgs):
+        """
+        Create the pool of ROOT files shared by the configurations, the number of prefetch threads is
+        the largest draw.prefetchWorkers among them
+        """
+
+        self.filePool = FPFilePool(workers=max(eval_i(cfg.GetOpt("draw.prefetchWorkers")) if cfg.OptExist("draw.prefetchWorkers") else 4
+                                               for cfg in cfgs))
+
+    def planCache(self, configs):
+        """
+        Create the histogram cache shared by the configurations drawn in the session: configs is the list
+        of the configurations with the plots drawn from each one [(cfg, plots_names)]
+        """
+
+        self.runCache = FPRunCache(configs)
+
+    ###---plots----------------------------------------------------------
+    def getJournal(self, cfg):
+        """
+        Journal of the completed plots of a configuration (keyed by the hash of the resolved configuration)
+        """
+
+        out_dir = cfg.GetOpt("draw.outDir") if cfg.OptExist("draw.outDir") else "plots"
+
+        return FPJournal(out_dir, hashlib.sha1(str(cfg).encode()).hexdigest())
+
+    def getPlotsNames(self, cfg, resume=False):
+        """
+        Return the plots listed in draw.plots. With resume the plots already completed
+        with the same resolved configuration are skipped.
+        """
+
+        plots_names = [str(plot_name) for plot_name in cfg.GetVOpt("draw.plots")] if cfg.OptExist("draw.plots") else []
+        if resume:
+            journal = self.getJournal(cfg)
+            plots_names = [plot_name for plot_name in plots_names if not journal.isDone(plot_name)]
+
+        return plots_names
+
+    def drawPlots(self, cfg, plugin_funcs, force_update=False, resume=False, keep_files=set(), write=True, keep_plots=False,
+                  close_files=True):
+        """
+        Draw all the plots listed in draw.plots:
+        + write: hand the output of each plot to the write processes
+        + keep_plots: return the plots ({plot_name: FPPlot}) instead of freeing their objects
+        ROOT files listed in keep_files (all the files if close_files is false) are left open for the following configurations.
+        """
+
+        plots = odict()
+        if not cfg.OptExist("draw.plots"):
+            return plots
+        plots_names = self.getPlotsNames(cfg, resume)
+        if len(plots_names) < len(cfg.GetVOpt("draw.plots")):
+            printMessage("Resuming: "+str(len(cfg.GetVOpt("draw.plots"))-len(plots_names))+" plots already completed", 0)
+        #---the output directory and the journal are created only if the outputs are written
+        journal = None
+        if write:
+            out_dir = cfg.GetOpt("draw.outDir") if cfg.OptExist("draw.outDir") else "plots"
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            journal = self.getJournal(cfg)
+            self.journals.append(journal)
+        max_memory = cfg.GetDoubleOpt("draw.maxMemory") if cfg.OptExist("draw.maxMemory") else 0
+        #---index of the last plot referencing each source by name
+        last_use = {}
+        kept = set()
+        preexisting = set(ROOT.addressof(obj) for obj in ROOT.gDirectory.GetList())
+        for iplot, plot_name in enumerate(plots_names):
+            for histo_key in getHistoKeys(cfg, plot_name):
+                for src in getSourceNames(cfg, histo_key):
+                    last_use[src] = iplot
+        #---ROOT files read by each plot, opened in background by the file pool
+        #   while the previous plots are being drawn
+        plots_files = getPlotsFiles(cfg, plots_names)
+        prefetch_depth = eval_i(cfg.GetOpt("draw.prefetchDepth")) if cfg.OptExist("draw.prefetchDepth") else 10
+        if not self.filePool:
+            self.openFilePool([cfg])
+        run_cache = self.runCache if self.runCache else FPRunCache([(cfg, plots_names)])
+        progress = FPProgress(len(plots_names),
+                              str(cfg.GetOpt("draw.metricsFile")) if cfg.OptExist("draw.metricsFile") else "",
+                              cfg.GetDoubleOpt("draw.metricsInterval") if cfg.OptExist("draw.metricsInterval") else 10.,
+                              eval_b(cfg.GetOpt("draw.progress")) if cfg.OptExist("draw.progress") else False)
+        memory_report = FPMemoryReport(str(cfg.GetOpt("draw.memoryReport"))) if cfg.OptExist("draw.memoryReport") else None
+        for iplot, plot_name in enumerate(plots_names):
+            for files in plots_files[iplot:iplot+prefetch_depth+1]:
+                self.filePool.prefetch(files)
+            printMessage("Drawing <"+colors.CYAN+plot_name+colors.DEFAULT+">", 1)        
+            if memory_report:
+                memory_report.startPlot(plot_name)
+            plot = FPPlot(plot_name, cfg, plugin_funcs, force_update, file_pool=self.filePool, run_cache=run_cache,
+                          progress=progress, memory_report=memory_report)
+            if memory_report:
+                memory_report.endPlot(plot, plot.basedir.load())
+            #---write output in parallel: the write processes are forked and get their own
+            #   copy of the canvas, ownership of the output is transferred without copying it
+            output = plot.getOutput() if write else {}
+            #---the prefetch threads must not use ROOT while the writers are forked
+            with self.filePool.paused():
+                procs = writeOutput(output, self.writeProcs)
+            if journal:
+                journal.track(plot_name, procs, [output['basename']+'.'+ext for ext in output['exts']]+
+                              ([output['basename']+'.txt'] if len(output['description']) else []) if output else [])
+            progress.plotDone(self.writeProcs)
+            if keep_plots:
+                plots[plot_name] = plot
+            else:
+                #---free objects not referenced by the following plots and the objects kept
+                #   by the previous plots whose last consumer is this plot
+                keep = set(src for src, last in last_use.items() if last > iplot)
+                plot.release(keep=keep)
+                releaseObjects(plot.basedir.load(), kept-keep, preexisting)
+                kept = keep
+            del plot, output
+            if memory_report:
+                memory_report.releasedPlot()
+            #---close files not read by the following plots
+            for path in plots_files[iplot]:
+                if close_files and path not in keep_files and not any(path in files for files in plots_files[iplot+1:iplot+prefetch_depth+1]):
+                    self.filePool.close(path)
+            if max_memory > 0:
+                enforceMemoryBudget(max_memory, self.writeProcs, run_cache)
+        if journal:
+            journal.update()
+
+        return plots
+
+    def waitWriters(self):
+        """
+        Wait for the running write processes and record their plots in the journals
+        """
+
+        for proc in self.writeProcs:
+            proc.join()
+        del self.writeProcs[:]
+        for journal in self.journals:
+            journal.update()
+        del self.journals[:]
+
+    def resetStyle(self):
+        self.style.Copy(ROOT.gStyle)
+
+    def close(self):
+        self.waitWriters()
+        if self.filePool:
+            self.filePool.closeAll()
+            self.filePool = None
+        self.runCache = None
+
+###---ROOT files read by each plot----------------------------------------
+def getPlotsFiles(cfg, plots_names):
+    """
+    Return the ROOT files read by each plot: a list of {path: {tree_name: branches}}.
+    Files read by nested histogram sources are included.
+    """
+
+    plots_files = []
+    for plot_name in plots_names:
+        plots_files.append({})
+        for histo_key in getHistoKeys(cfg, plot_name):
+            for src in [histo_key]+[src for src in getSourceNames(cfg, histo_key) if cfg.OptExist(src+".src")]:
+                for path, trees in getHistoFiles(cfg, src).items():
+                    for tree, branches in trees.items():
+                        plots_files[-1].setdefault(path, {}).setdefault(tree, set()).update(branches)
+
+    return plots_files
+
+###---batch entries--------------------------------------------------------
+def getBatchEntries(cmd_opts, parser):
+    """
+    Return the options of each configuration to be drawn: one entry for each cfg file given with -c,
+    plus one entry for each line of the --batch manifest (each line holds the draw.py options of one entry).
+    """
+
+    entries = []
+    for cfg_path in cmd_opts.cfg if len(cmd_opts.cfg) else ([''] if cmd_opts.batch == '' else []):
+        entry = argparse.Namespace(**vars(cmd_opts))
+        entry.cfg = cfg_path
+        entries.append(entry)
+    if cmd_opts.batch != '':
+        with open(cmd_opts.batch) as manifest:
+            for line in manifest:
+                if line.split('#')[0].strip() == '':
+                    continue
+                entry = parser.parse_args(shlex.split(line, comments=True))
+                for cfg_path in entry.cfg if len(entry.cfg) else ['']:
+                    entries.append(argparse.Namespace(**vars(entry)))
+                    entries[-1].cfg = cfg_path
+
+    return entries
+
+def draw(cmd_opts=None, parser=None):
+    """
+    FuriousPlotter main loop: the configurations listed on the command line (several -c files or a --batch manifest)
+    are drawn one after the other in the same session
+    """
+
+    session = FPSession()
+    entries = getBatchEntries(cmd_opts, parser)
+    configs = []
+    for entry in entries:
+        presets = entry.preset.split(',') if entry.preset != "" else []
+        mods = entry.mod.split(',') if entry.mod != "" else []
+        configs.append(session.loadConfig(entry.cfg, presets, mods, not entry.no_cfg_cache))
+        if entry.preview > 0:
+            configs[-1].ParseConfigString("draw.preview "+str(entry.preview))
+    #---ROOT files read by each configuration: kept open until the last configuration reading them.
+    #   The file pool and the histogram cache are shared by all the configurations.
+    configs_files = []
+    configs_plots = []
+    for ientry, cfg in enumerate(configs):
+        plots_names = session.getPlotsNames(cfg, entries[ientry].resume)
+        configs_files.append(set(path for files in getPlotsFiles(cfg, plots_names) for path in files))
+        if not entries[ientry].plan:
+            configs_plots.append((cfg, plots_names))
+    session.openFilePool(configs)
+    session.planCache(configs_plots)
+
+    for ientry, entry in enumerate(entries):
+        session.resetStyle()
+        drawConfig(session, configs[ientry], entry, keep_files=set().union(*configs_files[ientry+1:]))
+    session.close()
+
+def drawConfig(session, cfg, cmd_opts, keep_files=set()):
+    """
+    Draw a single configuration
+    """
 
     if cmd_opts.debug:
         print(cfg)
         
-    #---Load py/C++ plugins, proccess all lines before
-    sys.path.insert(1, os.getcwd())
-    plugin_funcs = {}
-    plugins = {"py" : ['operations'], "C" : [], "so" : [], "line" : []}    
-    if cfg.OptExist("draw.plugins"):        
-        for plugin in cfg.GetVOpt("draw.plugins"):
-            plugin = str(plugin)
-            if ".py" == plugin[-3:]:
-                plugins["py"].append(plugin[:-3])
-            elif ".C" == plugin[-2:] or ".C+" == plugin[-3:]:
-                plugins["C"].append(plugin)
-            elif ".so" == plugin[-3:]:
-                plugins["so"].append(plugin)
-            else:
-                plugins["line"].append(plugin)
-    processLines(plugins["line"])
-    for plugin in plugins["py"]:
-        plugin_module = importlib.import_module(plugin)
-        for func_name in getattr(plugin_module, 'FPOperations'):
-            plugin_funcs[func_name] = getattr(plugin_module, func_name)
-    for macro in plugins["C"]:
-        ROOT.gROOT.LoadMacro(macro) 
-    for lib in plugins["so"]:
-        ROOT.gSystem.Load(lib) 
+    plugin_funcs = session.loadPlugins(cfg)
+
+    #---Dry run: report the expected I/O without filling anything
+    if cmd_opts.plan:
+        printMessage("Cache: parsed cfg "+("hit" if any(cfg is cached for cached in session.cachedConfigs) else "miss"), 0)
+        if cfg.OptExist("draw.plots"):
+            planRun(cfg, [str(plot_name) for plot_name in cfg.GetVOpt("draw.plots")], plugin_funcs)
+        return
 
     #---Create trees with FPTreeCreator
     if cmd_opts.make_trees and cfg.OptExist("draw.trees"):
@@ -71,38 +372,51 @@ def draw(cmd_opts=None):
             FPTreeCreator(cfg, tree_name, plugin_funcs)
 
     #---Make plots with FPPlots
-    #---keep track of write process running in parallel
-    write_procs = []
-    #---create line object for drawing custom lines
-    ROOT.gROOT.ProcessLine("TLine line;")
-    ROOT.gROOT.ProcessLine("TLatex latex;")
-    if cfg.OptExist("draw.plots"):
-        for plot_name in cfg.GetVOpt("draw.plots"):
-            printMessage("Drawing <"+colors.CYAN+plot_name+colors.DEFAULT+">", 1)        
-            plot = FPPlot(plot_name, cfg, plugin_funcs, cmd_opts.force_update)
-            output = copy.deepcopy(plot.getOutput())
-            #---write output in parallel
-            writeOutput(output, write_procs)
-    #---close write parallel processes
-    for proc in write_procs:
-        proc.join()
+    session.drawPlots(cfg, plugin_funcs, cmd_opts.force_update, cmd_opts.resume, keep_files)
         
-    #---Post-proc
+    #---Post-proc (after all the outputs have been written)
     if cfg.OptExist("draw.postProcCommands"):
+        session.waitWriters()
         for command in cfg.GetVOpt("draw.postProcCommands"):
             os.system(command)
 
+def enforceMemoryBudget(max_memory, write_procs, run_cache=None):
+    """
+    Keep the process resident memory below max_memory (MB):
+    + run the garbage collector to free released plot objects
+    + evict the objects cached for the following plots
+    + throttle: wait for the running write processes to complete
+    """
+
+    if getRSS() < max_memory:
+        return
+    gc.collect()
+    if getRSS() >= max_memory and run_cache:
+        run_cache.evict()
+        gc.collect()
+    if getRSS() >= max_memory and len(write_procs):
+        printMessage("Memory budget exceeded ("+str(int(getRSS()))+" MB), waiting for write processes", 0)
+        for proc in write_procs:
+            proc.join()
+        del write_procs[:]
+    if getRSS() >= max_memory:
+        printMessage("Memory budget exceeded: "+str(int(getRSS()))+" MB in use, draw.maxMemory is "+str(int(max_memory))+" MB", 0)
     
 ### MAIN ###
 if __name__ == "__main__":
     parser = argparse.ArgumentParser (description = 'Draw plots from ROOT files')
     parser.add_argument('-p', '--preset', type=str, default='', help='preset option passed to the config parser')
     parser.add_argument('-m', '--mod', type=str, default='', help='config file modifiers')
-    parser.add_argument('-c', '--cfg', default='', help='cfg file')
+    parser.add_argument('-c', '--cfg', nargs='+', default=[], help='cfg file(s), drawn one after the other in the same session')
+    parser.add_argument('--batch', type=str, default='', help='manifest file: each line holds the options (-c, -p, -m, ...) of one configuration')
     parser.add_argument('-f', '--force-update', action='store_true', default=False, help='force plots update')
     parser.add_argument('--make-trees', action='store_true', help='recreate every TTree defined in draw.trees')
+    parser.add_argument('--preview', type=float, default=0, metavar='FRACTION', help='fill the histograms from the first FRACTION of each tree')
+    parser.add_argument('--resume', action='store_true', help='skip the plots completed by a previous run with the same configuration')
+    parser.add_argument('--plan', action='store_true', help='report files, entries and bytes to be read without drawing')
+    parser.add_argument('--no-cfg-cache', action='store_true', help='parse the cfg files ignoring the cached configuration')
     parser.add_argument('--debug', action='store_true', help='print debug information')
     
     cmd_opts = parser.parse_args()
 
-    draw(cmd_opts=cmd_opts)
+    draw(cmd_opts=cmd_opts, parser=parser)
@@ -0,0 +1,183 @@
+#!/bin/python
+
+import os
+import re
+import weakref
+import threading
+import ROOT
+
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future
+from fp_utils import *
+
+###---pools with a prefetch thread pool
+_pools = weakref.WeakSet()
+
+@contextmanager
+def prefetchPaused():
+    """
+    Pause the prefetch of all the file pools of the process, for code forking outside the plot loop
+    (multiprocessing pools of the operations and readers)
+    """
+
+    with ExitStack() as stack:
+        for pool in list(_pools):
+            stack.enter_context(pool.paused())
+        yield
+
+###---file pool class-------------------------------------------------
+class FPFilePool:
+    """
+    Pool of ROOT files shared by the plots of a run.
+    Files can be prefetched: they are opened concurrently by a background thread pool and the
+    TTreeCache of the trees read by the plots is warmed for the branches used in var/cut.
+    The prefetch must be paused while the process forks (write processes, multiprocessing pools):
+    a child forked while a background thread holds a ROOT lock would deadlock.
+    """
+
+    def __init__(self, workers=4, cache_size=30000000):
+        self.files     = {}
+        self.cacheSize = cache_size
+        self.executor  = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.gate      = threading.Condition()
+        self.pauses    = 0
+        self.active    = 0
+        if self.executor:
+            ROOT.EnableThreadSafety()
+            #---let the background threads run while waiting for the network
+            ROOT.TFile.Open.__release_gil__ = True
+            ROOT.TBranch.GetEntry.__release_gil__ = True
+            _pools.add(self)
+
+    ###---open a file in the pool---------------------------------------
+    def openFile(self, path, trees={}):
+        """
+        Open file and warm the TTreeCache of the specified trees ({tree_name: [branches]})
+        """
+
+        tfile = ROOT.TFile.Open(path)
+        if not tfile or tfile.IsZombie():
+            return tfile
+        ROOT.SetOwnership(tfile, False)
+        for tree_name, branches in trees.items():
+            tree = tfile.Get(tree_name)
+            if not tree or not tree.InheritsFrom("TTree"):
+                continue
+            tree.SetCacheSize(self.cacheSize)
+            cached = [branch for branch in branches if tree.GetBranch(branch)]
+            for branch in cached:
+                tree.AddBranchToCache(branch, True)
+            tree.StopCacheLearningPhase()
+            #---reading the first entry of one cached branch fills the cache for the first cluster
+            if len(cached) and tree.GetEntries() > 0:
+                tree.GetBranch(cached[0]).GetEntry(0)
+
+        return tfile
+
+    ###---schedule files opening----------------------------------------
+    def prefetch(self, sources):
+        """
+        Open files in background: sources is a dictionary {path: {tree_name: [branches]}}
+        """
+
+        for path, trees in sources.items():
+            if path not in self.files:
+                if self.executor:
+                    self.files[path] = self.executor.submit(self.prefetchFile, path, trees)
+                else:
+                    self.files[path] = self.openFile(path, trees)
+
+    def prefetchFile(self, path, trees):
+        """
+        Open a file in a background thread, waiting while the prefetch is paused
+        """
+
+        with self.gate:
+            while self.pauses:
+                self.gate.wait()
+            self.active += 1
+        try:
+            return self.openFile(path, trees)
+        finally:
+            with self.gate:
+                self.active -= 1
+                self.gate.notify_all()
+
+    @contextmanager
+    def paused(self):
+        """
+        Hold the prefetch for the duration of the block: the files being opened are completed, the queued ones
+        wait for the end of the block (nothing is cancelled). No background thread is using ROOT within the block.
+        """
+
+        with self.gate:
+            self.pauses += 1
+            while self.active:
+                self.gate.wait()
+        try:
+            yield
+        finally:
+            with self.gate:
+                self.pauses -= 1
+                self.gate.notify_all()
+
+    ###---get file------------------------------------------------------
+    def get(self, path):
+        """
+        Return the open file, waiting for the prefetch to complete if needed
+        """
+
+        if path not in self.files:
+            self.files[path] = self.openFile(path)
+        elif isinstance(self.files[path], Future):
+            self.files[path] = self.files[path].result()
+
+        return self.files[path]
+
+    def owns(self, path):
+        return path in self.files
+
+    ###---close files---------------------------------------------------
+    def close(self, path):
+        """
+        Close file and remove it from the pool
+        """
+
+        if path in self.files:
+            tfile = self.get(path)
+            if tfile:
+                tfile.Close()
+            del self.files[path]
+
+    def closeAll(self):
+        for path in list(self.files.keys()):
+            self.close(path)
+        if self.executor:
+            self.executor.shutdown()
+            _pools.discard(self)
+
+###---collect the ROOT files read by a histogram--------------------------
+def getHistoFiles(cfg, histo_key):
+    """
+    Return the ROOT files read by a histogram as a dictionary {path: {tree_name: [branches]}}.
+    Branches are the identifiers found in the histogram var and cut options.
+    """
+
+    files = {}
+    tokens = set()
+    for opt in [".var", ".cut"]:
+        for value in cfg.GetVOpt(histo_key+opt) if cfg.OptExist(histo_key+opt) else []:
+            tokens |= set(re.findall(r'[A-Za-z_]\w*', str(value)))
+    current = None
+    for src in cfg.GetVOpt(histo_key+".src") if cfg.OptExist(histo_key+".src") else []:
+        src = str(src)
+        if ":" in src:
+            src = src[src.find(":")+1:]
+        path = expand_path(src)
+        if ".root" in path and (os.path.isfile(path) or "/eos/user" in src or path[:7] == "root://"):
+            current = path
+            files.setdefault(current, {})
+        elif current:
+            files[current][src] = sorted(tokens)
+
+    return files
@@ -0,0 +1,70 @@
+#!/bin/python
+
+import ROOT
+import cfgmanager
+
+from draw import *
+
+###---in-process session shared by all the calls
+_session = None
+_plots = odict()
+
+def getSession():
+    """
+    Return the session of the current process (created at the first call)
+    """
+
+    global _session
+    if not _session:
+        _session = FPSession()
+
+    return _session
+
+def run(cfg="", presets=[], mods=[], write=False, force_update=False):
+    """
+    Draw the plots of a configuration in the current process and return them as a dictionary {plot_name: FPPlot}:
+    the histograms are stored in FPPlot.histos, the canvas in FPPlot.pads[plot_name].
+
+    - usage: ``plots = fp.run("my.cfg", mods=["draw.plots myplot"])``
+
+    Plugins and open ROOT files are reused by the following calls. The plots returned by a call are
+    released when run is called again.
+
+    :param cfg: cfg file path or an already parsed CfgManager (presets and mods are ignored).
+    :type cfg: str or cfgmanager.CfgManager
+    :param presets: options parsed before the cfg file.
+    :type presets: list
+    :param mods: options parsed after the cfg file.
+    :type mods: list
+    :param write: write the output files (saveAs formats) as draw.py does.
+    :type write: bool
+    :returns: the plots drawn.
+    """
+
+    session = getSession()
+    for plot in _plots.values():
+        plot.release()
+    _plots.clear()
+    session.resetStyle()
+
+    if isinstance(cfg, str):
+        cfg = session.loadConfig(cfg, presets, mods)
+    plugin_funcs = session.loadPlugins(cfg)
+    _plots.update(session.drawPlots(cfg, plugin_funcs, force_update, write=write, keep_plots=True, close_files=False))
+    if write:
+        session.waitWriters()
+
+    return odict(_plots)
+
+def close():
+    """
+    Release the plots and close the files opened by the session
+    """
+
+    global _session
+    for plot in _plots.values():
+        plot.release()
+    _plots.clear()
+    if _session:
+        _session.close()
+        _session = None
@@ -7,6 +7,7 @@ import argparse
 import os
 import subprocess
 import multiprocessing as mp
+import numpy as np
 import ROOT
 
 from ROOT import std
@@ -48,7 +49,8 @@ def processLines(lines):
 ###---write subprocess manager----------------------------------------
 def writeOutput(output, write_procs):
     """
-    Spawn a process to write each output file
+    Spawn a process to write each output file.
+    Returns the processes spawned for this output.
     """
 
     #---check for terminated processes and cleanup
@@ -57,22 +59,37 @@ def writeOutput(output, write_procs):
             proc.join()
             write_procs.pop(idx)
 
+    #---nothing to write (saveAs goff)
+    if not output:
+        return []
+    out_dir = os.path.dirname(output['basename'])
+    if out_dir != "" and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    
     #---spawn new processes
+    procs = []
     for ext in output['exts']:
         # proc = mp.Process(target=writeFile, args=(output['canvas'], output['basename']+'.'+ext, ext, output['cfg'])) do not save the cfg for now
-        proc = mp.Process(target=writeFile, args=(output['canvas'], output['basename']+'.'+ext, ext))
+        proc = mp.Process(target=writeFile, args=(output['canvas'], output['basename']+'.'+ext, ext, output.get('display', []),
+                                                  output.get('histos', {})))
         proc.start()
         write_procs.append(proc)
+        procs.append(proc)
     if len(output['description']) > 0:
         proc = mp.Process(target=writeDescription, args=(output['description'], output['basename']+'.txt'))
         proc.start()
         write_procs.append(proc)
+        procs.append(proc)
+
+    return procs
         
 ###---write single output file----------------------------------------
 # def writeFile(canvas, name, ext, cfg): do not save the cfg for now
-def writeFile(canvas, name, ext):
+def writeFile(canvas, name, ext, display=[], histos={}):
     """
-    Write single output file. This function is called by the parallel manager
+    Write single output file. This function is called by the parallel manager.
+    Image outputs draw the reduced resolution objects listed in display [(pad, full, reduced), ...]
+    Numeric outputs (npz, h5) store the arrays of the plot histograms instead of the canvas.
     """
 
     if ext == "root":
@@ -80,9 +97,63 @@ def writeFile(canvas, name, ext):
         canvas.Write()
         # cfg.Write()
         rfile.Close()
+    elif ext in ("npz", "h5"):
+        exportArrays(histos, name, ext)
     else:
+        #---the write process owns a copy of the canvas: swap the objects in place
+        for pad, full, reduced in display:
+            link = pad.GetListOfPrimitives().FirstLink()
+            while link:
+                if ROOT.addressof(link.GetObject()) == ROOT.addressof(full):
+                    link.SetObject(reduced)
+                link = link.Next()
+            pad.Modified()
         canvas.Print(name, ext)
 
+###---numeric export--------------------------------------------------
+def getObjectArrays(obj):
+    """
+    Return the arrays describing a plot object:
+    + histograms: class, bin edges of each axis, contents and errors (underflow and overflow included)
+    + graphs: class, x, y and the low/high errors
+    Other objects (TF1, ...) are not exported.
+    """
+
+    if obj.InheritsFrom("TH1"):
+        arrays = {'class' : np.array(obj.ClassName()), 'contents' : np.array(getContentArray(obj)), 'errors' : getErrorArray(obj)}
+        for axis_name, axis in zip("xyz", [obj.GetXaxis(), obj.GetYaxis(), obj.GetZaxis()][:obj.GetDimension()]):
+            arrays['edges_'+axis_name] = getEdgesArray(axis)
+    elif obj.InheritsFrom("TGraph"):
+        arrays = dict(zip(['x', 'y', 'exl', 'exh', 'eyl', 'eyh'], getGraphArrays(obj)))
+        arrays['class'] = np.array(obj.ClassName())
+    else:
+        arrays = {}
+
+    return arrays
+
+def exportArrays(histos, name, ext):
+    """
+    Write the arrays of all the plot histograms ({histo_key: object}) to a single file:
+    + npz: uncompressed archive, arrays are stored as <histo_key>/<array> (loadable with numpy.load or memory-mapped)
+    + h5: one group per histogram (requires h5py)
+    """
+
+    arrays = {}
+    for histo_key, obj in histos.items():
+        for array_name, array in getObjectArrays(obj).items():
+            arrays[histo_key+"/"+array_name] = array
+    if ext == "npz":
+        np.savez(name, **arrays)
+    else:
+        try:
+            import h5py
+        except ImportError:
+            printMessage("h5py not available, cannot write "+name, -1)
+            return
+        with h5py.File(name, "w") as h5file:
+            for key, array in arrays.items():
+                h5file.create_dataset(key, data=array if array.dtype.kind != 'U' else str(array))
+
 ###---write single output file----------------------------------------
 def writeDescription(text, name):
     """
@@ -112,6 +183,18 @@ def eval_f(expr):
 
     return float(eval(expr))
 
+###---evaluate string as bool-----------------------------------------
+def eval_b(expr):
+    """
+    Evaluate expression an cast result as bool (true/false are accepted as well)
+    """
+
+    expr = str(expr).strip()
+    if expr.lower() in ("true", "false"):
+        return expr.lower() == "true"
+
+    return bool(eval(expr))
+
 ###---expand source path
 def expand_path(path):
     """
@@ -127,3 +210,301 @@ def expand_path(path):
             path = 'root://eosuser-internal.cern.ch/'+path
 
     return path
+
+###---memory usage---------------------------------------------------
+def getRSS():
+    """
+    Return the resident memory of the current process in MB
+    """
+
+    proc_info = ROOT.ProcInfo_t()
+    ROOT.gSystem.GetProcInfo(proc_info)
+
+    return proc_info.fMemResident/1024.
+
+def getObjectBytes(obj):
+    """
+    Estimate the bytes held by the bin arrays of a histogram (contents, sum of weights squared,
+    profile bin entries) or by the points of a graph
+    """
+
+    if obj.InheritsFrom("TH1"):
+        cname = obj.ClassName()
+        itemsize = np.dtype(_array_types[cname[-1]]).itemsize if cname[-1] in _array_types and "Profile" not in cname else 8
+        nbytes = obj.GetSize()*itemsize+8*obj.GetSumw2N()
+        if "Profile" in cname:
+            nbytes += 2*8*obj.GetSize()
+        return nbytes
+    elif obj.InheritsFrom("TGraph"):
+        narrays = 6 if obj.InheritsFrom("TGraphAsymmErrors") else 4 if obj.InheritsFrom("TGraphErrors") else 2
+        return 8*narrays*obj.GetN()
+
+    return 0
+
+###---cfg scanning helpers--------------------------------------------
+def getHistoKeys(cfg, plot_name):
+    """
+    Return the keys (pad_key.histo) of all the histograms drawn in a plot,
+    following the same pad ordering used by FPPlot.processPads
+    """
+
+    pad_keys = [plot_name]
+    for pad_name in cfg.GetVOpt(plot_name+".pads") if cfg.OptExist(plot_name+".pads") else []:
+        pad_keys.append(plot_name+"."+str(pad_name))
+    histo_keys = []
+    for pad_key in pad_keys:
+        for histo in cfg.GetVOpt(pad_key+".histos") if cfg.OptExist(pad_key+".histos") else []:
+            histo_keys.append(pad_key+"."+str(histo))
+
+    return histo_keys
+
+def getSourceNames(cfg, histo_key):
+    """
+    Return the source names (alias stripped) listed in the src option of a histogram.
+    Sources that are themselves histogram definitions are expanded recursively.
+    """
+
+    names = set()
+    for src in cfg.GetVOpt(histo_key+".src") if cfg.OptExist(histo_key+".src") else []:
+        src = str(src)
+        if ":" in src:
+            src = src[src.find(":")+1:]
+        names.add(src)
+        if src != histo_key and cfg.OptExist(src+".src"):
+            names |= getSourceNames(cfg, src)
+
+    return names
+
+###---histogram bin arrays---------------------------------------------
+_array_types = {'C' : np.int8, 'S' : np.int16, 'I' : np.int32, 'L' : np.int64, 'F' : np.float32, 'D' : np.float64}
+
+def getContentArray(histo):
+    """
+    Return the histogram bin contents (underflow and overflow included) as a numpy array
+    of shape (nx+2), (ny+2, nx+2) or (nz+2, ny+2, nx+2).
+    For plain histograms (TH*C/S/I/L/F/D) the array is a view of the ROOT bin array (no copy).
+    """
+
+    shape = [histo.GetNbinsX()+2]
+    if histo.GetDimension() > 1:
+        shape.insert(0, histo.GetNbinsY()+2)
+    if histo.GetDimension() > 2:
+        shape.insert(0, histo.GetNbinsZ()+2)
+    cname = histo.ClassName()
+    if "Profile" in cname or cname[-1] not in _array_types:
+        return np.array([histo.GetBinContent(ibin) for ibin in range(histo.GetSize())]).reshape(shape)
+    view = histo.GetArray()
+    view.reshape((histo.GetSize(),))
+
+    return np.frombuffer(view, dtype=_array_types[cname[-1]], count=histo.GetSize()).reshape(shape)
+
+def getErrorArray(histo):
+    """
+    Return the histogram bin errors with the same layout used by getContentArray
+    """
+
+    if "Profile" in histo.ClassName():
+        return np.array([histo.GetBinError(ibin) for ibin in range(histo.GetSize())]).reshape(getContentArray(histo).shape)
+    if histo.GetSumw2N() > 0:
+        sumw2 = histo.GetSumw2().GetArray()
+        sumw2.reshape((histo.GetSize(),))
+        return np.sqrt(np.frombuffer(sumw2, dtype=np.float64, count=histo.GetSize())).reshape(getContentArray(histo).shape)
+
+    return np.sqrt(np.abs(getContentArray(histo).astype(np.float64)))
+
+def getEdgesArray(axis):
+    """
+    Return the bin edges of a TAxis (fixed or variable size bins)
+    """
+
+    if axis.GetXbins().GetSize() > 0:
+        edges = axis.GetXbins().GetArray()
+        edges.reshape((axis.GetNbins()+1,))
+        return np.array(np.frombuffer(edges, dtype=np.float64, count=axis.GetNbins()+1))
+
+    return np.linspace(axis.GetXmin(), axis.GetXmax(), axis.GetNbins()+1)
+
+def getGraphArrays(graph):
+    """
+    Return the points of a TGraph as numpy arrays: x, y, exl, exh, eyl, eyh.
+    Errors are set to zero for graph types that do not define them.
+    """
+
+    npoints = graph.GetN()
+    def toArray(view):
+        if npoints == 0:
+            return np.zeros(0)
+        view.reshape((npoints,))
+        return np.array(np.frombuffer(view, dtype=np.float64, count=npoints))
+
+    x, y = toArray(graph.GetX()), toArray(graph.GetY())
+    if graph.InheritsFrom("TGraphAsymmErrors"):
+        return x, y, toArray(graph.GetEXlow()), toArray(graph.GetEXhigh()), toArray(graph.GetEYlow()), toArray(graph.GetEYhigh())
+    elif graph.InheritsFrom("TGraphErrors"):
+        ex, ey = toArray(graph.GetEX()), toArray(graph.GetEY())
+        return x, y, ex, ex, ey, ey
+
+    return x, y, np.zeros(npoints), np.zeros(npoints), np.zeros(npoints), np.zeros(npoints)
+
+###---array plugin operations------------------------------------------
+class FPHistoArrays:
+    """
+    Array view of a plot object, passed to the operations listed in FPArrayOperations:
+    + histograms: contents and errors (underflow and overflow included, same layout of getContentArray)
+      and edges (one array per axis)
+    + graphs: x, y, exl, exh, eyl, eyh
+    For plain histograms contents is a read-only view of the ROOT bin array (no copy).
+    """
+
+    def __init__(self, obj):
+        self.name  = obj.GetName()
+        self.title = obj.GetTitle()
+        if obj.InheritsFrom("TH1"):
+            self.contents = getContentArray(obj)
+            self.contents.flags.writeable = False
+            self.errors = getErrorArray(obj)
+            self.edges = [getEdgesArray(axis) for axis in [obj.GetXaxis(), obj.GetYaxis(), obj.GetZaxis()][:obj.GetDimension()]]
+        else:
+            self.x, self.y, self.exl, self.exh, self.eyl, self.eyh = getGraphArrays(obj)
+
+def makeObjectFromArrays(result, name, template=None):
+    """
+    Build the output of an array operation. result can be:
+    + a FPHistoArrays or a dictionary with contents, errors (optional) and edges (optional, taken from template if missing)
+    + a (contents, errors) tuple (edges taken from template)
+    + a FPHistoArrays or a dictionary with x, y and the optional errors (exl, exh, eyl, eyh): a TGraphAsymmErrors is created
+    Contents and errors can include the underflow/overflow bins or not.
+    """
+
+    if isinstance(result, tuple):
+        result = {'contents' : result[0], 'errors' : result[1] if len(result) > 1 else None}
+    elif not isinstance(result, dict):
+        result = vars(result)
+
+    #---graph
+    if 'x' in result:
+        x = np.ascontiguousarray(result['x'], dtype=np.float64)
+        errs = [np.ascontiguousarray(result[key], dtype=np.float64) if result.get(key, None) is not None else np.zeros(len(x))
+                for key in ['exl', 'exh', 'eyl', 'eyh']]
+        graph = ROOT.TGraphAsymmErrors(len(x), x, np.ascontiguousarray(result['y'], dtype=np.float64), *errs)
+        graph.SetName(name)
+        return graph
+
+    #---histogram: variable size bins built from the edges
+    edges = result.get('edges', None)
+    if edges is None:
+        edges = [getEdgesArray(axis) for axis in [template.GetXaxis(), template.GetYaxis(), template.GetZaxis()][:template.GetDimension()]]
+    edges = [np.ascontiguousarray(axis_edges, dtype=np.float64) for axis_edges in edges]
+    args = []
+    for axis_edges in edges:
+        args += [len(axis_edges)-1, axis_edges]
+    histo = [ROOT.TH1D, ROOT.TH2D, ROOT.TH3D][len(edges)-1](name, template.GetTitle() if template else "", *args)
+    histo.Sumw2()
+    shape = tuple(len(axis_edges)+1 for axis_edges in reversed(edges))
+    def toBins(values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != shape:
+            values = np.pad(values.reshape(tuple(size-2 for size in shape)), 1)
+        return np.ascontiguousarray(values).ravel()
+    contents = toBins(result['contents'])
+    histo.SetContent(contents)
+    histo.SetError(toBins(result['errors']) if result.get('errors', None) is not None else np.sqrt(np.abs(contents)))
+    histo.SetEntries(contents.sum())
+
+    return histo
+
+def makeArrayOperation(func):
+    """
+    Wrap an array operation into a FP operation: the histogram/graph arguments are passed as FPHistoArrays
+    (positional or keyword arguments as in the cfg), any other argument as string.
+    The returned arrays are converted into a ROOT object (see makeObjectFromArrays) using the first object
+    argument as template.
+    """
+
+    def operation(*args, **kwargs):
+        if len(args) == 2 and isinstance(args[0], list):
+            names, srcs = args
+            result = func(*[FPHistoArrays(srcs[arg]) if arg in srcs else arg for arg in names])
+        else:
+            srcs = args[0]
+            names = list(kwargs.values())
+            result = func(**{key : FPHistoArrays(srcs[value]) if value in srcs else value for key, value in kwargs.items()})
+        template = next((srcs[arg] for arg in names if arg in srcs), None)
+
+        return makeObjectFromArrays(result, re.sub(r'\W', '_', func.__name__+"_"+"_".join(names)), template)
+
+    operation.__name__ = func.__name__
+    operation.__doc__ = func.__doc__
+
+    return operation
+
+###---display resolution-----------------------------------------------
+def rebinForDisplay(histo, width, height):
+    """
+    Rebin TH2/TH3 histograms so that the number of bins does not exceed the pad pixel grid (width x height).
+    Bins are merged in groups dividing the original number of bins, the content is averaged
+    over the merged bins so that the color scale is preserved. Axes without a divisor of the number
+    of bins up to twice the required group (e.g. prime number of bins) are not rebinned.
+    Returns None if no rebinning is needed.
+    """
+
+    pixels = [width, height, min(width, height)]
+    axes = [histo.GetXaxis(), histo.GetYaxis(), histo.GetZaxis()][:histo.GetDimension()]
+    groups = []
+    for axis, npixels in zip(axes, pixels):
+        target = max(1, -(-axis.GetNbins()//max(1, npixels)))
+        groups.append(next((group for group in range(target, 2*target+1) if axis.GetNbins() % group == 0), 1))
+    if all(group == 1 for group in groups):
+        return None
+
+    if histo.GetDimension() == 2:
+        reduced = histo.Rebin2D(groups[0], groups[1], histo.GetName()+"_display")
+    else:
+        reduced = histo.Rebin3D(groups[0], groups[1], groups[2], histo.GetName()+"_display")
+    reduced.SetDirectory(0)
+    if "Profile" not in histo.ClassName():
+        reduced.Scale(1./np.prod(groups))
+    palette = reduced.GetListOfFunctions().FindObject("palette")
+    if palette:
+        palette.SetHistogram(reduced)
+
+    return reduced
+
+def decimateGraph(graph, nbuckets):
+    """
+    Shape preserving decimation of a TGraph: the x range is split in nbuckets columns and for each
+    column the first, last, minimum and maximum points are kept (in their original order).
+    Returns None if the graph has less than 4*nbuckets points.
+    """
+
+    x, y, exl, exh, eyl, eyh = getGraphArrays(graph)
+    if len(x) <= 4*nbuckets:
+        return None
+
+    span = x.max()-x.min()
+    bucket = np.minimum(((x-x.min())/(span if span > 0 else 1.)*nbuckets).astype(np.int64), nbuckets-1)
+    buckets, first = np.unique(bucket, return_index=True)
+    last = len(bucket)-1-np.unique(bucket[::-1], return_index=True)[1]
+    by_y = np.lexsort((y, bucket))
+    y_min = by_y[np.searchsorted(bucket[by_y], buckets, side='left')]
+    y_max = by_y[np.searchsorted(bucket[by_y], buckets, side='right')-1]
+    keep = np.unique(np.concatenate((first, last, y_min, y_max)))
+
+    x, y = x[keep], y[keep]
+    if graph.InheritsFrom("TGraphAsymmErrors"):
+        reduced = ROOT.TGraphAsymmErrors(len(keep), x, y, exl[keep], exh[keep], eyl[keep], eyh[keep])
+    elif graph.InheritsFrom("TGraphErrors"):
+        reduced = ROOT.TGraphErrors(len(keep), x, y, exl[keep], eyl[keep])
+    else:
+        reduced = ROOT.TGraph(len(keep), x, y)
+    reduced.SetName(graph.GetName()+"_display")
+    reduced.SetTitle(graph.GetTitle())
+    ROOT.TAttLine.Copy(graph, reduced)
+    ROOT.TAttFill.Copy(graph, reduced)
+    ROOT.TAttMarker.Copy(graph, reduced)
+    axes = graph.GetHistogram().Clone(graph.GetHistogram().GetName()+"_display")
+    axes.SetDirectory(0)
+    ROOT.SetOwnership(axes, False)
+    reduced.SetHistogram(axes)
+
+    return reduced
@@ -6,9 +6,12 @@ import time
 import argparse
 import os
 import subprocess
+import multiprocessing as mp
+import numpy as np
 import ROOT
 
 from fp_utils import *
+from file_manager import prefetchPaused
 from array import array
 
 def Add(args, srcs):
@@ -225,13 +228,16 @@ def Project(srcs, name="", axis="X", min=None, max=None):
         
     return tmp
 
-def FitSlices(srcs, name="", axis="X", func=0, parameter="_0", min=None, max=None):
+def FitSlices(srcs, name="", axis="X", func=0, parameter="_0", min=None, max=None, workers=1):
     """
     Interface to the FitSlicesX and FitSlicesY methods of ``TH2``. Returns the requested post-fit histogram.
 
-    
+    - with ``workers`` > 1 the slices are fitted by a pool of processes, results are collected in bin order.
+      Each fit starts from the initial function parameters, so the result does not depend on the scheduling.
     """
 
+    th2 = srcs[name]
+
     ### check inputs
     if "TH2" not in th2.ClassName():
         printMessage("ERROR: FitSlices operation requires a TH2 histogram as first parameter, got"+th2.ClassName()+" instead", -1)
@@ -240,7 +246,6 @@ def FitSlices(srcs, name="", axis="X", func=0, parameter="_0", min=None, max=Non
         printMessage("ERROR: FitSlices operation, unsupported axis name: "+axis, -1)
         return
     
-    th2 = srcs[name]
     if func in srcs.keys():
         fit_func = srcs[func]
     else:
@@ -249,8 +254,11 @@ def FitSlices(srcs, name="", axis="X", func=0, parameter="_0", min=None, max=Non
         if not max:
             max = th2.GetYaxis().GetBinUpEdge(th2.GetYaxis().GetLast()) if axis == "X" else th2.GetXaxis().GetBinUpEdge(th2.GetXaxis().GetLast())
             
-        fit_func = ROOT.TF1("fit_slices_x_func", func.replace('"', ''), min, max)
-                            
+        fit_func = ROOT.TF1("fit_slices_x_func", func.replace('"', ''), eval_f(str(min)), eval_f(str(max)))
+
+    if eval_i(str(workers)) > 1:
+        return fitSlicesParallel(th2, fit_func, axis, parameter, eval_i(str(workers)))
+    
     if axis == "X":
         th2.FitSlicesX(fit_func)
     else:
@@ -258,20 +266,79 @@ def FitSlices(srcs, name="", axis="X", func=0, parameter="_0", min=None, max=Non
         
     return ROOT.gDirectory.Get(th2.GetName()+parameter)
 
-def FitSlicesX(srcs, name="", func=0, parameter="_0", min=None, max=None):
+###---shared state of the slice fits (inherited by the forked workers)
+_fit_slices_state = {}
+
+def _fitSlice(ibin):
+    """
+    Fit a single slice of the TH2 stored in _fit_slices_state.
+    Returns the bin number, the fitted parameters, their errors and the chi2/ndf (None if the slice is empty)
+    """
+
+    th2 = _fit_slices_state['th2']
+    fit_func = _fit_slices_state['func']
+    if _fit_slices_state['axis'] == "X":
+        proj = th2.ProjectionX("_fs_"+str(ibin), ibin, ibin, "e")
+    else:
+        proj = th2.ProjectionY("_fs_"+str(ibin), ibin, ibin, "e")
+    if proj.GetEntries() == 0:
+        return ibin, None, None, None
+    fit_func.SetParameters(_fit_slices_state['init'])
+    proj.Fit(fit_func, "QNR0")
+    npar = fit_func.GetNpar()
+    ndf = fit_func.GetNDF()
+    chi2 = fit_func.GetChisquare()/ndf if ndf > 0 else 0.
+
+    return ibin, [fit_func.GetParameter(i) for i in range(npar)], [fit_func.GetParError(i) for i in range(npar)], chi2
+
+def fitSlicesParallel(th2, fit_func, axis, parameter, workers):
+    """
+    Fit the slices of a TH2 on a pool of processes. Returns a histogram (named as the ROOT FitSlices output)
+    holding the requested parameter (``_<ipar>`` or ``_chi2``) for each slice.
+    """
+
+    slice_axis = th2.GetYaxis() if axis == "X" else th2.GetXaxis()
+    _fit_slices_state['th2'] = th2
+    _fit_slices_state['func'] = fit_func
+    _fit_slices_state['axis'] = axis
+    _fit_slices_state['init'] = array('d', [fit_func.GetParameter(i) for i in range(fit_func.GetNpar())])
+    with prefetchPaused():
+        pool = mp.get_context('fork').Pool(workers)
+    results = pool.map(_fitSlice, range(1, slice_axis.GetNbins()+1))
+    pool.close()
+    pool.join()
+
+    edges = getEdgesArray(slice_axis)
+    h_tmp = ROOT.TH1D(th2.GetName()+parameter, fit_func.GetName()+parameter, len(edges)-1, edges)
+    contents = np.zeros(h_tmp.GetSize())
+    errors = np.zeros(h_tmp.GetSize())
+    for ibin, pars, errs, chi2 in results:
+        if pars is None:
+            continue
+        if parameter == "_chi2":
+            contents[ibin] = chi2
+        else:
+            contents[ibin] = pars[int(parameter.lstrip("_"))]
+            errors[ibin] = errs[int(parameter.lstrip("_"))]
+    h_tmp.SetContent(contents)
+    h_tmp.SetError(errors)
+
+    return h_tmp
+
+def FitSlicesX(srcs, name="", func=0, parameter="_0", min=None, max=None, workers=1):
     """
     Call the fit slices method of TH2 and returns the requested post-fit histogram
     """
 
-    FitSlices(srcs, name=name, axis="X", func=func, parameter=parameter, min=min, max=max)
+    return FitSlices(srcs, name=name, axis="X", func=func, parameter=parameter, min=min, max=max, workers=workers)
 
-def FitSlicesY(srcs, name="", func=0, parameter="_0", min=None, max=None):
+def FitSlicesY(srcs, name="", func=0, parameter="_0", min=None, max=None, workers=1):
     """
     Call the fit slices method of TH2 and returns the requested post-fit histogram
     """
 
-    FitSlices(srcs, name=name, axis="Y", func=func, parameter=parameter, min=min, max=max)
-    
+    return FitSlices(srcs, name=name, axis="Y", func=func, parameter=parameter, min=min, max=max, workers=workers)
+
 def QuantileBinning(srcs, name, nqx=0, nqy=0):
     """
     Define ``TH2`` axis binning using quantile of projected distribution(s).
@@ -279,6 +346,8 @@ def QuantileBinning(srcs, name, nqx=0, nqy=0):
     """    
 
     h_orig = srcs[name]
+    nqx = eval_i(str(nqx))
+    nqy = eval_i(str(nqy))
 
     ###---compute de quantiles ranges
     hx_tmp = h_orig.ProjectionX(h_orig.GetName()+"_px", 1, h_orig.GetNbinsY())
@@ -298,11 +367,12 @@ def QuantileBinning(srcs, name, nqx=0, nqy=0):
         printMessage("y-ayis quantile binning: ", 0)
         print(quantiles_y)
 
-    ###---build new histogram
+    ###---build new histogram, refill it at once (FillN) with the original bin contents
+    x_centers = getEdgesArray(h_orig.GetXaxis())
+    x_centers = (x_centers[:-1]+x_centers[1:])/2.
     if "TH1" in h_orig.ClassName() and nqx > 0:
         h_tmp = ROOT.TH1D("tmp", "", nqx-1, quantiles_x)
-        for ibin in range(1, h_orig.GetNbinsX()+1):
-            h_tmp.Fill(h_orig.GetBinCenter(ibin), h_orig.GetBinContent(ibin)) 
+        h_tmp.FillN(len(x_centers), x_centers, np.ascontiguousarray(getContentArray(h_orig)[1:-1], dtype=np.float64))
     elif "TH2" in h_orig.ClassName():
         if nqx > 0 and nqy > 0:
             h_tmp = ROOT.TH2D("tmp", "", nqx-1, quantiles_x, nqy-1, quantiles_y)
@@ -314,9 +384,10 @@ def QuantileBinning(srcs, name, nqx=0, nqy=0):
             h_tmp = ROOT.TH2D("tmp", "",
                               h_orig.GetNbinsX(), hx_tmp.GetBinLowEdge(1), hx_tmp.GetBinLowEdge(h_orig.GetNbinsX()+1),
                               nqy-1, quantiles_y)
-        for xbin in range(1, h_orig.GetNbinsX()+1):
-            for ybin in range(1, h_orig.GetNbinsY()+1):
-                h_tmp.Fill(hx_tmp.GetBinCenter(xbin), hy_tmp.GetBinCenter(ybin), h_orig.GetBinContent(xbin, ybin))        
+        y_centers = getEdgesArray(h_orig.GetYaxis())
+        y_centers = (y_centers[:-1]+y_centers[1:])/2.
+        weights = np.ascontiguousarray(getContentArray(h_orig)[1:-1, 1:-1], dtype=np.float64).ravel()
+        h_tmp.FillN(len(weights), np.tile(x_centers, len(y_centers)), np.repeat(y_centers, len(x_centers)), weights)
     else:
         h_tmp = h_orig.Clone("tmp")
 
@@ -328,6 +399,9 @@ def QuantileProf(srcs, name="", qvalues=None):
     Options:
     1) when only one value is specified the function calculates two quatiles: 0.5-opt/2, 0.5+opt/2
     2) the first argument must a TH2.
+
+    The quantiles of all the x bins are computed in a single pass from the cumulative sums of the TH2 bin array
+    (same interpolation as ``TH1::GetQuantiles``).
     """
 
     ### check input arguments
@@ -335,27 +409,40 @@ def QuantileProf(srcs, name="", qvalues=None):
         printMessage("QuintileProf: no qvalues specified", -1)
         exit(-1)
     h_orig = srcs[name]
-    nbins = srcs[name].GetNbinsX()
+    if isinstance(qvalues, str):
+        qvalues = qvalues.strip("[]").split(",")
+    qvalues = [float(qvalue) for qvalue in qvalues]
 
     ### define quantiles
-    if len(qvalues) == 2:
-        probs = array('d', [0.5-float(qvalues)/2., 0.5, 0.5+float(qvalues)/2.])
+    if len(qvalues) == 1:
+        probs = [0.5-qvalues[0]/2., 0.5, 0.5+qvalues[0]/2.]
     else:
-        probs = array('d', [float(qvalues[0]), 0.5, float(qvalues[1])])
-    quantiles = array('d', [0, 0, 0])
-
-    ### create output histogram
-    h_tmp = ROOT.TGraphAsymmErrors()
-    
-    ### compute errors for each x bin
-    h_projx = h_orig.ProjectionX()
-    for xbin in range(1, nbins+1):
-        h_proj = h_orig.ProjectionY("_py", xbin, xbin, "o")
-        if h_proj.GetEntries() > 0:
-            h_proj.GetQuantiles(3, quantiles, probs)
-            h_tmp.SetPoint(h_tmp.GetN(), h_projx.GetBinCenter(xbin), quantiles[1])
-            h_tmp.SetPointError(h_tmp.GetN()-1, 0, 0, quantiles[1]-quantiles[0], quantiles[2]-quantiles[1])
-            quantiles = array('d', [0, 0, 0])
+        probs = [qvalues[0], 0.5, qvalues[1]]
+
+    ### normalized cumulative distribution of each x bin (column), under/overflow excluded
+    contents = getContentArray(h_orig)[1:-1, 1:-1].astype(np.float64)
+    nybins, nxbins = contents.shape
+    integral = np.vstack((np.zeros(nxbins), np.cumsum(contents, axis=0)))
+    filled = integral[-1] != 0
+    integral = integral[:, filled]/integral[-1, filled]
+    columns = np.arange(integral.shape[1])
+    y_edges = getEdgesArray(h_orig.GetYaxis())
+
+    ### compute the quantiles of all the x bins at once
+    quantiles = []
+    for prob in probs:
+        ibin = np.clip((integral <= prob).sum(axis=0)-1, 0, nybins-1)
+        low = integral[ibin, columns]
+        dint = integral[ibin+1, columns]-low
+        step = np.divide((y_edges[ibin+1]-y_edges[ibin])*(prob-low), dint, out=np.zeros(len(dint)), where=dint>0)
+        quantiles.append(y_edges[ibin]+step)
+
+    ### create output graph
+    x_edges = getEdgesArray(h_orig.GetXaxis())
+    x_centers = ((x_edges[:-1]+x_edges[1:])/2.)[filled]
+    zeros = np.zeros(len(x_centers))
+    h_tmp = ROOT.TGraphAsymmErrors(len(x_centers), x_centers, quantiles[1], zeros, zeros,
+                                   quantiles[1]-quantiles[0], quantiles[2]-quantiles[1])
 
     return h_tmp
 
@@ -380,25 +467,43 @@ def TH1ToGraph(srcs, name=""):
 def SpectrumAwareGraph(srcs, name="", spectrum=""):
     """
     Set x position of args[0] (graph) points accordingly to args[1] (TH1) average in the same bin  
+
+    The spectrum average in the range of each point is computed from the prefix sums of the bin contents
+    (same bins and bin centers used by ``TH1::GetMean`` after ``SetRangeUser``), the spectrum is not modified.
     """
 
     orig_gr = srcs[name]
     spectrum = srcs[spectrum]  
 
     if "TH1" in orig_gr.ClassName():
-        orig_gr = th1_to_graph(srcs, name=name)
-
-    px = orig_gr.GetX()
-    py = orig_gr.GetY()
-    ex = orig_gr.GetEX()
-    ey = orig_gr.GetEY()
-        
-    tmp = ROOT.TGraphAsymmErrors()
-    for ib in range(0, orig_gr.GetN()):
-        spectrum.GetXaxis().SetRangeUser(px[ib]-ex[ib], px[ib]+ex[ib])
-        mean = spectrum.GetMean()
-        tmp.SetPoint(ib, mean, py[ib])
-        tmp.SetPointError(ib, mean-px[ib]+ex[ib], px[ib]-mean+ex[ib], ey[ib], ey[ib])
+        orig_gr = TH1ToGraph(srcs, name=name)
+
+    px, py, ex, _, ey, _ = getGraphArrays(orig_gr)
+
+    ### prefix sums of the spectrum weights and weighted bin centers
+    edges = getEdgesArray(spectrum.GetXaxis())
+    nbins = len(edges)-1
+    weights = getContentArray(spectrum)[1:-1].astype(np.float64)
+    sum_w = np.concatenate(([0.], np.cumsum(weights)))
+    sum_wx = np.concatenate(([0.], np.cumsum(weights*(edges[:-1]+edges[1:])/2.)))
+
+    ### bin range selected by TAxis::SetRangeUser(px-ex, px+ex) for each point
+    low, high = px-ex, px+ex
+    first = np.searchsorted(edges, low, side='right')
+    last = np.searchsorted(edges, high, side='right')
+    first = np.where(edges[np.clip(first, 0, nbins)] <= low, first+1, first)
+    last = np.where(edges[np.clip(last-1, 0, nbins)] >= high, last-1, last)
+    first = np.clip(first, 1, nbins)
+    last = np.clip(last, 1, nbins)
+    empty_range = last < first
+    first = np.where(empty_range, 1, first)
+    last = np.where(empty_range, nbins, last)
+
+    ### average of the spectrum in each range (0 if the range is empty, as TH1::GetMean)
+    norm = sum_w[last]-sum_w[first-1]
+    mean = np.divide(sum_wx[last]-sum_wx[first-1], norm, out=np.zeros(len(norm)), where=norm!=0)
+
+    tmp = ROOT.TGraphAsymmErrors(len(mean), mean, py, mean-px+ex, px-mean+ex, ey, ey)
 
     return tmp
 
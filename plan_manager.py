@@ -0,0 +1,95 @@
+#!/bin/python
+
+import os
+import re
+import ROOT
+
+from fp_utils import *
+from file_manager import getHistoFiles
+from cache_manager import *
+
+###---dry run planner--------------------------------------------------
+def planRun(cfg, plots_names, plugin_funcs):
+    """
+    Resolve plots, histograms, operations and sources without filling anything and print the expected cost:
+    + files to open, trees and entries to scan
+    + compressed bytes of the branches referenced by var and cut
+    + number of passes (TTree::Draw calls) per tree, after merging compatible binnings and identical definitions
+    + cache hits expected from previous runs (text sources)
+    """
+
+    run_cache = FPRunCache([(cfg, plots_names)])
+    nhistos = sum(len(getHistoKeys(cfg, plot_name)) for plot_name in plots_names)
+    printMessage("Plan: "+str(len(plots_names))+" plots, "+str(nhistos)+" histograms, "+
+                 str(len(run_cache.definitions))+" distinct definitions", 1)
+
+    #---operations: check that every function is available
+    for definition, histo_key in run_cache.definitions.items():
+        if cfg.OptExist(histo_key+".operation"):
+            for func in re.findall(r'(\w+)\(', str(cfg.GetOpt(histo_key+".operation"))):
+                if func not in plugin_funcs:
+                    printMessage("operation <"+colors.CYAN+func+colors.DEFAULT+"> used by "+histo_key+" not found", -1)
+
+    #---passes over each tree: one per definition, fills derived from a fine fill are counted once
+    passes = {}
+    fine_fills = set()
+    other_srcs = {}
+    for definition, histo_key in run_cache.definitions.items():
+        src_vect = [str(src) for src in cfg.GetVOpt(histo_key+".src")] if cfg.OptExist(histo_key+".src") else []
+        for isrc, src in enumerate(src_vect):
+            path = expand_path(src.split(":")[-1])
+            if os.path.isfile(path) and ".root" not in path:
+                #---text sources can be followed by a branch descriptor
+                other_srcs[path] = src_vect[isrc+1] if isrc+1 < len(src_vect) and src_vect[isrc+1].count(":") > 1 else ""
+        if not cfg.OptExist(histo_key+".var"):
+            continue
+        spec = getBinningSpec(cfg, histo_key)
+        for path, trees in getHistoFiles(cfg, histo_key).items():
+            for tree in trees:
+                fill_key = getFillKey(cfg, histo_key, path, tree)
+                if fill_key in run_cache.fineSpecs and spec in run_cache.derivable[fill_key]:
+                    if fill_key in fine_fills:
+                        continue
+                    fine_fills.add(fill_key)
+                passes[(path, tree)] = passes.get((path, tree), 0)+1
+
+    #---trees: entries and compressed bytes of the referenced branches (only the file headers are read)
+    files = {}
+    for plot_name in plots_names:
+        for histo_key in getHistoKeys(cfg, plot_name):
+            for src in [histo_key]+[src for src in getSourceNames(cfg, histo_key) if cfg.OptExist(src+".src")]:
+                for path, trees in getHistoFiles(cfg, src).items():
+                    for tree, branches in trees.items():
+                        files.setdefault(path, {}).setdefault(tree, set()).update(branches)
+    total_entries = 0
+    total_bytes = 0
+    for path, trees in files.items():
+        tfile = ROOT.TFile.Open(path)
+        if not tfile or tfile.IsZombie():
+            printMessage("file "+colors.CYAN+path+colors.DEFAULT+" cannot be opened", -1)
+            continue
+        printMessage("file "+colors.CYAN+path+colors.DEFAULT, 0)
+        for tree_name, branches in trees.items():
+            tree = tfile.Get(tree_name)
+            if not tree or not tree.InheritsFrom("TTree"):
+                continue
+            npasses = passes.get((path, tree_name), 0)
+            zip_bytes = sum(tree.GetBranch(branch).GetZipBytes("*") for branch in branches if tree.GetBranch(branch))
+            total_entries += tree.GetEntries()*npasses
+            total_bytes += zip_bytes*npasses
+            printMessage("   tree "+tree_name+": "+str(tree.GetEntries())+" entries, "+str(npasses)+" passes, "+
+                         "%.1f MB" % (zip_bytes/1e6)+" compressed per pass", 0)
+        tfile.Close()
+    for path in sorted(other_srcs):
+        printMessage("file "+colors.CYAN+path+colors.DEFAULT+" (%.1f MB)" % (os.path.getsize(path)/1e6), 0)
+
+    #---cache hits from previous runs
+    text_hits = 0
+    if cfg.OptExist("draw.textCache") and eval_b(cfg.GetOpt("draw.textCache")):
+        cache_dir = getCacheDir(cfg)
+        for path, branch_desc in other_srcs.items():
+            if os.path.isfile(os.path.join(cache_dir, "text_"+getTextCacheKey(path, branch_desc)+".root")):
+                text_hits += 1
+    printMessage("Cache: "+str(text_hits)+" text sources cached, "+
+                 str(sum(uses-1 for uses in run_cache.resultUses.values() if uses > 1))+" histograms reused within the run", 0)
+    printMessage("Total: %d entries to scan, %.1f MB compressed to read" % (total_entries, total_bytes/1e6), 1)
@@ -7,33 +7,219 @@ import random
 import os
 import copy
 import ctypes
+import math
+import hashlib
+import numpy as np
 import ROOT
 
 from plugins.yoda_reader import *
+from plugins.text_reader import *
+from plugins.array_reader import *
 from fp_utils import *
+from cache_manager import *
 from array import array
 from collections import OrderedDict as odict
 from ROOT import TH1F
 
+###---customize helpers-----------------------------------------------
+###---compiled customize functions, keyed by object class and lines
+_customize_functions = {}
+
+def parseCustomizeArgs(args_str):
+    """
+    Convert a C++ argument list made of literals and ROOT constants (e.g. kRed+2) to python values.
+    Raise ValueError for any other expression.
+    """
+
+    args = []
+    for token in re.findall(r'"[^"]*"|[^,]+', args_str):
+        token = token.strip()
+        if token == "":
+            continue
+        if token[0] == '"' and token[-1] == '"' and '\\' not in token:
+            args.append(token[1:-1])
+        elif token in ("true", "kTRUE", "false", "kFALSE"):
+            args.append(token in ("true", "kTRUE"))
+        elif re.match(r'^[+-]?\d+$', token):
+            args.append(int(token))
+        elif re.match(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?[fF]?$', token):
+            args.append(float(token.rstrip("fF")))
+        elif re.match(r'^k\w+\s*([+-]\s*\d+)?$', token):
+            const = re.match(r'^(k\w+)\s*(([+-])\s*(\d+))?$', token)
+            value = getattr(ROOT, const.group(1))
+            if not isinstance(value, int):
+                raise ValueError(token)
+            if const.group(2):
+                value += int(const.group(4)) if const.group(3) == "+" else -int(const.group(4))
+            args.append(value)
+        else:
+            raise ValueError(token)
+
+    return args
+
+def parseCustomizeLine(line):
+    """
+    Parse a customize line of the form this->Method(args)[->Method(args)...] with literal arguments.
+    Returns the list of (method, args) calls or None if the line cannot be executed through PyROOT.
+    """
+
+    line = line.strip().rstrip(';').strip()
+    if line[:6] != "this->":
+        return None
+    calls = re.findall(r'(\w+)\(((?:"[^"]*"|[^()"])*)\)', line[6:])
+    if "->".join(method+"("+args+")" for method, args in calls) != line[6:]:
+        return None
+    try:
+        return [(method, parseCustomizeArgs(args)) for method, args in calls]
+    except (ValueError, AttributeError):
+        return None
+
+def applyCustomizeCalls(obj, calls):
+    """
+    Execute parsed customize calls on obj. Returns False if PyROOT cannot resolve a call.
+    """
+
+    target = obj
+    try:
+        for method, args in calls:
+            target = getattr(target, method)(*args)
+    except (AttributeError, TypeError):
+        return False
+
+    return True
+
+def runCustomizeBatch(obj, lines):
+    """
+    Execute customize lines acting on obj as a single function, compiled once for each
+    object class and set of lines. Fall back to one ProcessLine per line if compilation fails.
+    """
+
+    if not len(lines):
+        return
+    code_key = (obj.ClassName(), tuple(lines))
+    if code_key not in _customize_functions:
+        fname = "fp_customize_"+hashlib.sha1(repr(code_key).encode()).hexdigest()[:16]
+        body = "\n".join("    "+line.replace("this", "fp_obj")+";" for line in lines)
+        if ROOT.gInterpreter.Declare("void "+fname+"("+obj.ClassName()+"* fp_obj)\n{\n"+body+"\n}"):
+            _customize_functions[code_key] = getattr(ROOT, fname)
+        else:
+            _customize_functions[code_key] = None
+    if _customize_functions[code_key]:
+        _customize_functions[code_key](obj)
+    else:
+        for line in lines:
+            ROOT.gROOT.ProcessLine(line.replace("this", obj.GetName())+";")
+    if obj.ClassName() == "TPad":
+        obj.Draw()
+
+###---sparse histograms helpers---------------------------------------
+_sparse_filler = None
+
+def fillSparseFromTree(sparse, tree, var, cut, chunk_size=1000000, max_entries=-1):
+    """
+    Fill a THnSparse from a TTree: var and cut are evaluated by TTree::Draw on blocks of chunk_size entries
+    (only the first max_entries entries are read if max_entries is not negative)
+    and the selected values are filled by a compiled loop (TTree::Draw cannot fill a THnSparse directly).
+    As for TTree::Draw the first expression in var is the last axis (z:y:x).
+    """
+
+    global _sparse_filler
+    if not _sparse_filler:
+        ROOT.gInterpreter.Declare("""
+        void fp_fill_sparse(THnSparse* h, Long64_t n, const Double_t* v1, const Double_t* v2, const Double_t* v3, const Double_t* w)
+        {
+            const Double_t* v[3] = {v1, v2, v3};
+            Double_t x[3];
+            Int_t ndim = h->GetNdimensions();
+            for(Long64_t i=0; i<n; ++i)
+            {
+                for(Int_t idim=0; idim<ndim; ++idim)
+                    x[idim] = v[ndim-1-idim][i];
+                h->Fill(x, w[i]);
+            }
+        }""")
+        _sparse_filler = ROOT.fp_fill_sparse
+
+    ndim = sparse.GetNdimensions()
+    estimate = tree.GetEstimate()
+    tree.SetEstimate(chunk_size+1)
+    last = tree.GetEntries() if max_entries < 0 else min(tree.GetEntries(), max_entries)
+    for first in range(0, last, chunk_size):
+        nsel = tree.Draw(var, cut, "goff", min(chunk_size, last-first), first)
+        #---array branches select more values than entries: grow the buffers and draw the chunk again
+        if nsel >= tree.GetEstimate():
+            tree.SetEstimate(nsel+1)
+            nsel = tree.Draw(var, cut, "goff", min(chunk_size, last-first), first)
+        if nsel >= tree.GetEstimate():
+            buffer_size = tree.GetEstimate()
+            tree.SetEstimate(estimate)
+            raise RuntimeError("sparse fill of "+var+": "+str(nsel)+" values selected, buffers hold "+str(buffer_size))
+        if nsel > 0:
+            _sparse_filler(sparse, nsel, tree.GetV1(), tree.GetV2(), tree.GetV3() if ndim == 3 else tree.GetV1(), tree.GetW())
+    tree.SetEstimate(estimate)
+
+def projectSparse(sparse, axes, name):
+    """
+    Project a THnSparse on the axes specified as a string of x, y, z (e.g. "xy"), errors are computed.
+    The dense histogram holds only the projected axes.
+    """
+
+    dims = ["xyz".index(axis) for axis in axes]
+    if len(dims) == 1:
+        projection = sparse.Projection(dims[0], "E")
+    elif len(dims) == 2:
+        #---THnBase::Projection(ydim, xdim) uses the first argument as y axis
+        projection = sparse.Projection(dims[1], dims[0], "E")
+    else:
+        projection = sparse.Projection(dims[0], dims[1], dims[2], "E")
+    projection.SetName(name)
+
+    return projection
+
+###---objects shared between plots------------------------------------
+def releaseObjects(directory, names, preexisting=set()):
+    """
+    Free the objects kept in directory for the following plots once their last consumer has been drawn.
+    Objects listed in preexisting (addresses of objects created before the plots) are left in place.
+    """
+
+    released = []
+    for obj in list(directory.GetList()):
+        if obj.GetName() in names and ROOT.addressof(obj) not in preexisting:
+            directory.Remove(obj)
+            if not obj.TestBit(ROOT.kCanDelete):
+                released.append(obj)
+    #---python deletes the objects when the last reference is dropped
+    for obj in released:
+        ROOT.SetOwnership(obj, True)
+
 ###---plot container class--------------------------------------------
 class FPPlot:
     """Main class: contains all the objects belonging to a plot instance"""
 
     ###---init function-----------------------------------------------
-    def __init__(self, plot_name, cfg, plugin_funcs, force_update=False):
+    def __init__(self, plot_name, cfg, plugin_funcs, force_update=False, file_pool=None, run_cache=None, progress=None,
+                 memory_report=None):
         self.basedir     = ROOT.gDirectory.CurrentDirectory()
         self.name        = plot_name
         self.cfg         = cfg
         self.output      = {}
         self.files       = {}        
+        self.filePool    = file_pool
+        self.runCache    = run_cache
+        self.progress    = progress
+        self.memoryReport = memory_report
+        self.scannedEntries = 0
         self.histos      = odict()
+        self.ownedSrcs   = set()
+        self.displayObjects = []
         self.updated     = {}
         self.pads        = odict()        
         self.functions   = plugin_funcs
         self.forceUpdate = force_update
+        self.preexisting = set(ROOT.addressof(obj) for obj in self.basedir.load().GetList())
+        #---the output directory is created when the output is written
         self.outDir      = self.cfg.GetOpt("draw.outDir") if self.cfg.OptExist("draw.outDir") else "plots"
-        if not os.path.isdir(self.outDir):
-            os.makedirs(self.outDir)
         
         ###---main loop
         self.processPads()
@@ -87,6 +273,8 @@ class FPPlot:
                     if len(pad_size) == 4:
                         self.autoRescale(self.histos[histo_key], self.updated[histo_key], x_scale=pad_x_scale, y_scale=pad_y_scale)
                     self.histos[histo_key].Draw(draw_opt)
+                    if self.cfg.OptExist(histo_key+".displayResolution") or self.cfg.OptExist(self.name+".displayResolution"):
+                        self.displayObjects.append((pad, histo_key))
                     ### adjust maximum and minimum
                     if not first_histo:
                         first_histo = histo_key
@@ -112,6 +300,9 @@ class FPPlot:
             if len(pad_size) == 4:
                 self.autoRescale(pad, False, x_scale=pad_x_scale, y_scale=pad_y_scale)                
                 
+        if self.isPreview():
+            self.drawPreviewMark()
+
         ###---if option 'saveAs' is specified override global option
         save_opt = self.cfg.GetVOpt(self.name+".saveAs") if self.cfg.OptExist(self.name+".saveAs") else self.cfg.GetVOpt("draw.saveAs")
         ###---save canvas if not disabled
@@ -228,7 +419,9 @@ class FPPlot:
         self.output = {'canvas'      : self.pads[self.name],
                        'basename'    : self.outDir+"/"+self.name,
                        'description' : description,
-                       'exts'        : exts
+                       'exts'        : exts,
+                       'display'     : self.makeDisplayObjects(),
+                       'histos'      : odict(self.histos)
                        #'cfg'         : self.cfg.GetSubCfg(self.name)
                        }
 
@@ -237,6 +430,38 @@ class FPPlot:
         #     if ofile.ClassName() == "TFile":
         #         ofile.Close()
         
+    ###---reduced resolution objects for image outputs--------------------
+    def makeDisplayObjects(self):
+        """
+        Build reduced copies of the objects drawn with the displayResolution option (histo or plot scope):
+        + TH2/TH3 are rebinned to the pad pixel grid (or to the specified number of bins)
+        + TGraphs are decimated keeping the first, last, minimum and maximum point of each pixel column
+        The writer draws the reduced objects in the image outputs, the root output keeps the full resolution objects.
+        Returns a list of (pad, full resolution object, reduced object).
+        """
+
+        display = []
+        for pad, histo_key in self.displayObjects:
+            key = histo_key if self.cfg.OptExist(histo_key+".displayResolution") else self.name
+            resolution = self.cfg.GetVOpt(key+".displayResolution")
+            if str(resolution[0]) == "auto":
+                width = int(pad.GetWw()*pad.GetAbsWNDC()*(1-pad.GetLeftMargin()-pad.GetRightMargin()))
+                height = int(pad.GetWh()*pad.GetAbsHNDC()*(1-pad.GetTopMargin()-pad.GetBottomMargin()))
+            else:
+                width = eval_i(str(resolution[0]))
+                height = eval_i(str(resolution[1])) if len(resolution) > 1 else width
+            obj = self.histos[histo_key]
+            if "TH2" in obj.ClassName() or "TH3" in obj.ClassName():
+                reduced = rebinForDisplay(obj, width, height)
+            elif "Graph" in obj.ClassName():
+                reduced = decimateGraph(obj, width)
+            else:
+                reduced = None
+            if reduced:
+                display.append((pad, obj, reduced))
+
+        return display
+
     ###---retrive canvas and save directive-------------------------------
     def getOutput(self):
         """
@@ -245,6 +470,41 @@ class FPPlot:
 
         return self.output
 
+    ###---free plot objects---------------------------------------------
+    def release(self, keep=set()):
+        """
+        Free the objects created by this plot once its output has been handed off to the writer.
+        Objects appended to the session directory whose name is listed in keep are left in place
+        since following plots may still retrieve them as sources.
+        """
+
+        basedir = self.basedir.load()
+        released = []
+        for obj in list(basedir.GetList()):
+            if ROOT.addressof(obj) in self.preexisting or obj.GetName() in keep:
+                continue
+            basedir.Remove(obj)
+            if not obj.TestBit(ROOT.kCanDelete):
+                released.append(obj)
+
+        #---detach primitives from the canvas, objects owned by the pads are deleted here
+        if self.name in self.pads and self.pads[self.name].GetName() not in keep:
+            self.pads[self.name].Clear()
+
+        #---hand ownership of the remaining objects to python so that they are deleted
+        #   as soon as the last reference is dropped
+        for obj in released:
+            ROOT.SetOwnership(obj, True)
+        for path, ofile in self.files.items():
+            #---files shared through the pool are closed by the pool itself
+            if "TFile" in ofile.ClassName() and not (self.filePool and self.filePool.owns(path)):
+                ofile.Close()
+        self.files.clear()
+        self.histos.clear()
+        self.pads.clear()
+        self.displayObjects = []
+        self.output = {}
+
     ###---check if output already exist and if source is unchanged--------
     def getPreviousResult(self, histo_key):
         """
@@ -304,18 +564,43 @@ class FPPlot:
         ### check if previous result is current
         self.updated[histo_key] = None # if self.forceUpdate else self.getPreviousResult(histo_key)
         self.basedir.load().cd()
+        rss_before = getRSS() if self.memoryReport else 0
+        ### same definition already computed in this run: get a copy of the result
+        result_key = self.runCache.getResultKey(self.cfg, histo_key) if self.runCache else None
+        if result_key and not self.updated[histo_key]:
+            self.histos[histo_key] = self.runCache.getResult(result_key, histo_key.replace(".", "_"))
+            if self.histos[histo_key]:
+                if "Graph" in self.histos[histo_key].ClassName():
+                    ROOT.gDirectory.Append(self.histos[histo_key])
+                elif "TF1" not in self.histos[histo_key].ClassName():
+                    self.histos[histo_key].SetDirectory(self.basedir.load())
+                if self.memoryReport:
+                    self.memoryReport.recordHistogram(histo_key, self.histos[histo_key], rss_before)
+                return
+            del self.histos[histo_key]
         if not self.updated[histo_key]:
             ### process sources
             srcs = self.sourceParser(histo_key)
-            print(srcs)
             for key in srcs:
-                if srcs[key].ClassName() == "TTree" and self.cfg.OptExist(histo_key+".var"):
-                    srcs[key] = self.makeHistogramFromTTree(srcs[key], histo_key)                    
+                if srcs[key].ClassName() in ("TTree", "FPTextSource", "FPArraySource") and self.cfg.OptExist(histo_key+".var"):
+                    start = time.time()
+                    tree = srcs[key]
+                    self.scannedEntries = 0
+                    srcs[key] = self.makeHistogramFromTTree(tree, histo_key)                    
+                    self.ownedSrcs.add(ROOT.addressof(srcs[key]))
+                    #---histograms derived from a fine fill already done are not recorded
+                    if self.progress and self.scannedEntries > 0:
+                        self.progress.recordFill(self.getTreeLabel(tree), self.scannedEntries, time.time()-start)
                 if not any(rtype in srcs[key].ClassName() for rtype in ('TTree', 'Graph', 'TF1')) and not srcs[key].GetSumw2():
                     srcs[key].Sumw2()
                 if not self.cfg.OptExist(histo_key+".operation"):
                     if histo_key not in self.histos.keys():
-                        self.histos[histo_key] = srcs[key].Clone(histo_key.replace(".", "_"))
+                        #---single source created by this histogram: adopt it instead of cloning
+                        if len(srcs) == 1 and ROOT.addressof(srcs[key]) in self.ownedSrcs:
+                            self.histos[histo_key] = srcs[key]
+                            self.histos[histo_key].SetName(histo_key.replace(".", "_"))
+                        else:
+                            self.histos[histo_key] = srcs[key].Clone(histo_key.replace(".", "_"))
                         if "Graph" in self.histos[histo_key].ClassName():
                             ROOT.gDirectory.Append(self.histos[histo_key])
                     else:
@@ -330,6 +615,12 @@ class FPPlot:
                 if "Graph" in self.histos[histo_key].ClassName():
                     ROOT.gDirectory.Append(self.histos[histo_key])
 
+            if result_key:
+                self.runCache.storeResult(result_key, self.histos[histo_key])
+
+        if self.memoryReport:
+            self.memoryReport.recordHistogram(histo_key, self.histos.get(histo_key, None), rss_before)
+
     ###---operations-----------------------------------------------------
     def operationParser(self, operation, srcs):
         """
@@ -394,8 +685,11 @@ class FPPlot:
                 if abs_path not in self.files.keys():
                     ### file is a ROOT file
                     if ".root" in abs_path:
-                        self.files[abs_path] = ROOT.TFile.Open(abs_path)
-                        ROOT.SetOwnership(self.files[abs_path], False)
+                        if self.filePool:
+                            self.files[abs_path] = self.filePool.get(abs_path)
+                        else:
+                            self.files[abs_path] = ROOT.TFile.Open(abs_path)
+                            ROOT.SetOwnership(self.files[abs_path], False)
                         ### get primitives objects from all the canvas stored in the file
                         for fkey in self.files[abs_path].GetListOfKeys():
                             fobj = self.files[abs_path].Get(fkey.GetName())                            
@@ -417,20 +711,40 @@ class FPPlot:
                         else:
                             alias = src_vect[1]
                         srcs[alias] = readYODA(abs_path, src_vect[1])
+                        self.ownedSrcs.add(ROOT.addressof(srcs[alias]))
                         src_vect.erase(src_vect.begin()+1)
+                    ### numpy file: memory-mapped columns, the source is shared by all the histograms of the plot
+                    elif abs_path[-4:] in (".npy", ".npz"):
+                        chunk_size = self.cfg.GetOpt("draw.arrayChunkSize") if self.cfg.OptExist("draw.arrayChunkSize") else 1000000
+                        self.files[abs_path] = FPArraySource(abs_path, eval_i(str(chunk_size)))
                     ### txt file (load data with TTree::ReadFile). TTree is stored both in self.files and srcs
                     else:
-                        self.files[abs_path] = ROOT.TTree()
                         ### check if next src is a branch descriptor
                         branch_desc = ''
                         #delimiter = ' '
                         if len(src_vect)>1 and src_vect[1].count(":")>1:
                             branch_desc = src_vect[1]
-                        self.files[abs_path].ReadFile(abs_path, branch_desc)
-                        srcs[alias] = self.files[abs_path]
+                        ### streaming reader: parse the file in chunks while filling the histogram
+                        chunk_size = self.cfg.GetOpt(histo_key+".textChunkSize") if self.cfg.OptExist(histo_key+".textChunkSize") else \
+                                     self.cfg.GetOpt("draw.textChunkSize") if self.cfg.OptExist("draw.textChunkSize") else 0
+                        if eval_i(str(chunk_size)) > 0 and self.cfg.OptExist(histo_key+".var"):
+                            workers = self.cfg.GetOpt("draw.textWorkers") if self.cfg.OptExist("draw.textWorkers") else 1
+                            self.files[abs_path] = FPTextSource(abs_path, branch_desc, eval_i(str(chunk_size)), eval_i(str(workers)))
+                            srcs[alias] = self.files[abs_path]
+                        ### binary cache: the text file is converted once into a ROOT file
+                        elif self.cfg.OptExist("draw.textCache") and eval_b(self.cfg.GetOpt("draw.textCache")):
+                            self.files[abs_path] = ROOT.TFile.Open(getTextCache(abs_path, branch_desc, getCacheDir(self.cfg)))
+                            ROOT.SetOwnership(self.files[abs_path], False)
+                            srcs[alias] = self.files[abs_path].Get("fp_text")
+                        else:
+                            self.files[abs_path] = ROOT.TTree()
+                            self.files[abs_path].ReadFile(abs_path, branch_desc)
+                            srcs[alias] = self.files[abs_path]
                         src_vect.erase(src_vect.begin()+1)
                 if abs_path in self.files and  "File" in self.files[abs_path].ClassName():
                     histo_file = self.files[abs_path]
+                elif abs_path in self.files and self.files[abs_path].ClassName() == "FPArraySource":
+                    srcs[alias] = self.files[abs_path]
             # not a file: try to get it from current open file
             elif histo_file and histo_file.Get(src_vect[0]):
                 srcs[alias] = histo_file.Get(src_vect[0])
@@ -456,6 +770,7 @@ class FPPlot:
                     func.SetLineWidth(2)
                     func.SetTitle()
                     srcs[alias] = func                    
+                    self.ownedSrcs.add(ROOT.addressof(func))
                 else:
                     # bad source
                     printMessage("WARNING: source "+colors.CYAN+src_vect[0]+colors.DEFAULT+" not found.", 0)
@@ -475,6 +790,18 @@ class FPPlot:
     def makeHistogramFromTTree(self, histo_obj, histo_key):
         "Draw histograms from TTree, histogram type is guessed from specified binning"
 
+        ###---sparse storage (TH2/TH3 binnings only)
+        if self.cfg.OptExist(histo_key+".sparse") and eval_b(self.cfg.GetOpt(histo_key+".sparse")) and \
+           histo_obj.ClassName() == "TTree":
+            tmp_histo = self.makeSparseHistogramFromTTree(histo_obj, histo_key)
+            if tmp_histo:
+                return tmp_histo
+
+        ###---compatible binnings of the same tree, var and cut are derived from a single fine fill
+        fine_plan = self.runCache.getFinePlan(self.cfg, histo_obj, histo_key) if self.runCache else None
+        if fine_plan:
+            return self.deriveFromFineHistogram(histo_obj, histo_key, *fine_plan)
+
         ###---build histograms with fixed size bins 
         if self.cfg.OptExist(histo_key+".bins"):
             bins = self.cfg.GetVOpt(histo_key+".bins")
@@ -552,25 +879,194 @@ class FPPlot:
         # draw histo
         if 'name' not in locals():
             name = tmp.GetName() if 'tmp' in locals() else tmp_histo.GetName()
-        var = self.cfg.GetOpt(histo_key+".var")+">>"+name
-        cut = ""
-        if self.cfg.OptExist(histo_key+".cut"):
-            for next_cut in self.cfg.GetVOpt(histo_key+".cut"):                
-                cut += next_cut
-        histo_obj.Draw(var, cut, "goff")
+        var, cut = self.getDrawExpressions(histo_key)
+        nentries, scale = self.getPreviewEntries(histo_obj)
+        histo_obj.Draw(var+">>"+name, cut, "goff", nentries)
+        self.countScanned(histo_obj, nentries)
 
         # get histogram if binning was not specified
         if 'tmp_histo' not in locals():
             tmp_histo = ROOT.gDirectory.Get(name)
         
-        # convert TProfile2D in plain TH2F
+        # convert TProfile2D in plain TH2F (bin means and errors are copied at once)
         if 'tmp' in locals():
-            for xbin in range(1, tmp.GetNbinsX()+1):                
-                for ybin in range(1, tmp.GetNbinsY()+1):
-                    tmp_histo.SetBinContent(xbin, ybin, tmp.GetBinContent(xbin, ybin))
-                    tmp_histo.SetBinError(xbin, ybin, tmp.GetBinError(xbin, ybin))
-
+            means = tmp.ProjectionXY(tmp.GetName()+"_pxy", "e")
+            tmp_histo.SetContent(np.ascontiguousarray(getContentArray(means), dtype=np.float64).ravel())
+            tmp_histo.SetError(np.ascontiguousarray(getErrorArray(means), dtype=np.float64).ravel())
+            means.Delete()
             tmp.Delete()
+        # preview: rescale the yields (profiles hold mean values)
+        elif "Profile" not in tmp_histo.ClassName():
+            self.scalePreview(tmp_histo, scale)
+
+        return tmp_histo
+
+    ###---get sparse histogram from tree------------------------------------
+    def makeSparseHistogramFromTTree(self, histo_obj, histo_key):
+        """
+        Fill a THnSparse instead of a dense TH2/TH3 (option sparse), only the filled bins are stored.
+        The dense histogram is the projection on the axes drawn in the pad (option sparseProjection,
+        e.g. xy, default all axes). Returns None for binnings without a sparse equivalent (profiles).
+        """
+
+        axes = []
+        if self.cfg.OptExist(histo_key+".bins"):
+            bins = [str(value) for value in self.cfg.GetVOpt(histo_key+".bins")]
+            if len(bins) in (6, 9):
+                try:
+                    for iaxis in range(0, len(bins), 3):
+                        axes.append(np.linspace(eval_f(bins[iaxis+1]), eval_f(bins[iaxis+2]), eval_i(bins[iaxis])+1))
+                except (ValueError, NameError, SyntaxError):
+                    return None
+        elif self.cfg.OptExist(histo_key+".dbins"):
+            dbins = self.cfg.GetVOpt(histo_key+".dbins")
+            if len(dbins) == 2 and self.cfg.OptExist(dbins[0]) and self.cfg.OptExist(dbins[1]):
+                axes = [np.array(self.cfg.GetVDoubleOpt(dbins[iaxis])) for iaxis in range(2)]
+        if not len(axes):
+            return None
+
+        sparse = ROOT.THnSparseF("hs_"+histo_obj.GetName(), histo_key, len(axes),
+                                 array('i', [len(edges)-1 for edges in axes]),
+                                 array('d', [edges[0] for edges in axes]), array('d', [edges[-1] for edges in axes]))
+        for iaxis, edges in enumerate(axes):
+            sparse.GetAxis(iaxis).Set(len(edges)-1, np.ascontiguousarray(edges, dtype=np.float64))
+        sparse.Sumw2()
+        chunk_size = eval_i(self.cfg.GetOpt("draw.sparseChunkSize")) if self.cfg.OptExist("draw.sparseChunkSize") else 1000000
+        var, cut = self.getDrawExpressions(histo_key)
+        nentries, scale = self.getPreviewEntries(histo_obj)
+        fillSparseFromTree(sparse, histo_obj, var, cut, chunk_size, nentries if nentries != ROOT.TTree.kMaxEntries else -1)
+        self.countScanned(histo_obj, nentries)
+
+        projection = str(self.cfg.GetOpt(histo_key+".sparseProjection")) if self.cfg.OptExist(histo_key+".sparseProjection") else "xyz"[:len(axes)]
+        tmp_histo = projectSparse(sparse, projection, "h_"+histo_obj.GetName())
+        tmp_histo.SetTitle(histo_key)
+        tmp_histo.SetDirectory(self.basedir.load())
+        self.scalePreview(tmp_histo, scale)
+        sparse.Delete()
+
+        return tmp_histo
+
+    ###---tree label used by the progress metrics--------------------------
+    def getTreeLabel(self, tree):
+        if tree.ClassName() == "TTree":
+            return (tree.GetCurrentFile().GetName()+":" if tree.GetCurrentFile() else "")+tree.GetName()
+
+        return tree.path
+
+    ###---preview mode---------------------------------------------------
+    def getPreviewFraction(self):
+        """
+        Return the fraction of entries read in preview mode (1 if draw.preview is not set or not in (0, 1))
+        """
+
+        fraction = self.cfg.GetDoubleOpt("draw.preview") if self.cfg.OptExist("draw.preview") else 1.
+
+        return fraction if 0 < fraction < 1 else 1.
+
+    def getMaxEntries(self):
+        """
+        Return the maximum number of entries read in preview mode (-1 if draw.maxEntries is not set or not positive)
+        """
+
+        max_entries = eval_i(self.cfg.GetOpt("draw.maxEntries")) if self.cfg.OptExist("draw.maxEntries") else -1
+
+        return max_entries if max_entries > 0 else -1
+
+    def isPreview(self):
+        return self.getPreviewFraction() < 1 or self.getMaxEntries() > 0
+
+    def countScanned(self, histo_obj, nentries):
+        """
+        Record the entries read by a fill (nentries as passed to Draw, negative or kMaxEntries to read all the entries)
+        """
+
+        entries = histo_obj.GetEntries() if hasattr(histo_obj, "GetEntries") else 0
+        self.scannedEntries += entries if nentries < 0 or nentries >= entries else nentries
+
+    def getPreviewEntries(self, histo_obj):
+        """
+        Return the number of entries to be read from a tree and the factor rescaling the yields.
+        In preview mode (draw.preview fraction and/or draw.maxEntries) only the first entries are read,
+        text sources (unknown number of entries) are always read in full.
+        """
+
+        full = (ROOT.TTree.kMaxEntries if histo_obj.ClassName() == "TTree" else -1, 1.)
+        if not self.isPreview() or not hasattr(histo_obj, "GetEntries"):
+            return full
+        entries = histo_obj.GetEntries()
+        nentries = int(math.ceil(entries*self.getPreviewFraction()))
+        if self.getMaxEntries() > 0:
+            nentries = min(nentries, self.getMaxEntries())
+        if nentries <= 0 or nentries >= entries:
+            return full
+
+        return nentries, float(entries)/nentries
+
+    def scalePreview(self, histo, scale):
+        """
+        Rescale the yields (and the number of entries, used by NORM) of a histogram filled from a subset of the entries
+        """
+
+        if scale != 1.:
+            entries = histo.GetEntries()
+            histo.Scale(scale)
+            histo.SetEntries(entries*scale)
+
+    def drawPreviewMark(self):
+        """
+        Watermark the canvas of a plot drawn in preview mode
+        """
+
+        self.pads[self.name].cd()
+        mark = ROOT.TLatex(0.5, 0.5, "PREVIEW")
+        mark.SetName("fp_preview_mark")
+        mark.SetNDC()
+        mark.SetTextAlign(22)
+        mark.SetTextAngle(30)
+        mark.SetTextSize(0.15)
+        mark.SetTextColorAlpha(ROOT.kRed, 0.35)
+        self.basedir.load().Append(mark)
+        mark.Draw()
+
+    ###---var and cut expressions-----------------------------------------
+    def getDrawExpressions(self, histo_key):
+        """
+        Return the variable expression and the selection used to fill the histogram from a TTree
+        """
+
+        cut = ""
+        if self.cfg.OptExist(histo_key+".cut"):
+            for next_cut in self.cfg.GetVOpt(histo_key+".cut"):                
+                cut += next_cut
+
+        return str(self.cfg.GetOpt(histo_key+".var")), cut
+
+    ###---derive histogram from a fine binned fill----------------------
+    def deriveFromFineHistogram(self, histo_obj, histo_key, fill_key, fine_spec, spec):
+        """
+        Fill the tree once with the finest binning requested in the run for the same var and cut
+        (the fine histogram is kept in the run cache) and rebin it to the histogram binning
+        """
+
+        fine = self.runCache.getFill(fill_key)
+        if not fine:
+            name = "fp_fine_"+str(abs(hash(fill_key)))
+            if fine_spec[0] == "fixed":
+                fine = ROOT.TH1F(name, histo_key, fine_spec[1], fine_spec[2], fine_spec[3])
+            elif fine_spec[0] == "fixed2":
+                fine = ROOT.TH2F(name, histo_key, fine_spec[1], fine_spec[2], fine_spec[3], fine_spec[4], fine_spec[5], fine_spec[6])
+            else:
+                fine = ROOT.TH1F(name, histo_key, len(fine_spec[1])-1, array('d', fine_spec[1]))
+            var, cut = self.getDrawExpressions(histo_key)
+            histo_obj.Draw(var+">>"+name, cut, "goff", self.getPreviewEntries(histo_obj)[0])
+            self.countScanned(histo_obj, self.getPreviewEntries(histo_obj)[0])
+            fine.SetDirectory(0)
+            self.runCache.storeFill(fill_key, fine)
+
+        tmp_histo = rebinFineHistogram(fine, fine_spec, spec, "h_"+histo_obj.GetName())
+        tmp_histo.SetTitle(histo_key)
+        self.scalePreview(tmp_histo, self.getPreviewEntries(histo_obj)[1])
+        self.runCache.useFill(fill_key)
 
         return tmp_histo
 
@@ -581,18 +1077,37 @@ class FPPlot:
         """
 
         obj_definition_lines = []
+        batch = []
         if self.cfg.OptExist(key+".customize"):
             for line in self.cfg.GetVOpt(key+".customize"):
                 line = self.computeValues(line)
-                if line[:6] != "macro:":
+                is_macro = line[:6] == "macro:"
+                if not is_macro:
                     line = "this->"+line if line[:4] != "this" else line
                 else:
                     line = line[6:]
+                obj_line = line
                 for key, histo in self.histos.items():
                     if '=' in line:
                         line = line[:line.find('=')]+line[line.find('='):].replace(key, histo.GetName())
                     else:
                         line = line.replace(key, histo.GetName())
+
+                #---lines acting only on this object: setters are called directly through PyROOT,
+                #   the others are collected and executed as a single compiled function
+                if not is_macro and '=' not in line and line == obj_line:
+                    calls = parseCustomizeLine(line)
+                    if calls:
+                        runCustomizeBatch(obj, batch)
+                        batch = []
+                    if not calls or not applyCustomizeCalls(obj, calls):
+                        batch.append(line)
+                    elif obj.ClassName() == "TPad":
+                        obj.Draw()
+                    continue
+
+                runCustomizeBatch(obj, batch)
+                batch = []
                 line = line.replace("this", obj.GetName())
                 line += ';'
                 if '=' in line:
@@ -601,6 +1116,7 @@ class FPPlot:
                 ROOT.gROOT.ProcessLine(line)
                 if obj.ClassName() == "TPad":
                     obj.Draw()
+            runCustomizeBatch(obj, batch)
                 
         for line in obj_definition_lines:
             self.getNewObject(line)
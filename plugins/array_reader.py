@@ -0,0 +1,252 @@
+import os
+import ast
+import zipfile
+import numpy as np
+import ROOT
+
+###---functions available in var and cut expressions
+_array_functions = {'sqrt' : np.sqrt, 'abs' : np.abs, 'fabs' : np.abs, 'exp' : np.exp, 'log' : np.log, 'log10' : np.log10,
+                    'pow' : np.power, 'sin' : np.sin, 'cos' : np.cos, 'tan' : np.tan, 'atan' : np.arctan, 'atan2' : np.arctan2,
+                    'Sqrt' : np.sqrt, 'Abs' : np.abs, 'Exp' : np.exp, 'Log' : np.log, 'Log10' : np.log10, 'Power' : np.power,
+                    'Sin' : np.sin, 'Cos' : np.cos, 'Tan' : np.tan, 'ATan' : np.arctan, 'ATan2' : np.arctan2,
+                    'min' : np.minimum, 'max' : np.maximum, 'Min' : np.minimum, 'Max' : np.maximum}
+
+###---compiled fill loop for the histogram types without FillN (TH3, TProfile2D)
+_array_filler = None
+
+class _VectorizeLogic(ast.NodeTransformer):
+    """
+    Turn the python logical operators (and, or, not, chained comparisons) into element-wise numpy calls
+    """
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        expr = node.values[0]
+        for value in node.values[1:]:
+            expr = ast.Call(func=ast.Name(id='fp_'+func, ctx=ast.Load()), args=[expr, value], keywords=[])
+
+        return expr
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(func=ast.Name(id='fp_logical_not', ctx=ast.Load()), args=[node.operand], keywords=[])
+
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        left = node.left
+        terms = []
+        for op, right in zip(node.ops, node.comparators):
+            terms.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+
+        return self.visit_BoolOp(ast.BoolOp(op=ast.And(), values=terms))
+
+def compileExpression(expr):
+    """
+    Compile a TTree::Draw like expression (C++ logical operators, TMath functions) into a python code
+    object evaluated element-wise on numpy arrays. Returns the code and the names it reads.
+    """
+
+    expr = expr.replace("TMath::", "").replace("&&", " and ").replace("||", " or ")
+    expr = expr.replace("!=", "\x00").replace("!", " not ").replace("\x00", "!=")
+    tree = ast.fix_missing_locations(_VectorizeLogic().visit(ast.parse(expr.strip(), mode='eval')))
+    names = set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+    return compile(tree, expr, 'eval'), names
+
+def splitVarExpression(varexp):
+    """
+    Split a var expression (z:y:x) into its components, C++ scope operators are preserved
+    """
+
+    return [var.replace("\x00", "::") for var in varexp.replace("::", "\x00").split(":")]
+
+def _readNpyHeader(afile):
+    """
+    Read the header of a .npy file object: returns shape, fortran order and dtype
+    """
+
+    version = np.lib.format.read_magic(afile)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(afile)
+
+    return np.lib.format.read_array_header_2_0(afile)
+
+def _mapNpzMember(path, zfile, info):
+    """
+    Memory-map an uncompressed member of a npz archive (None for compressed members)
+    """
+
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as afile:
+        #---skip the zip local header: 30 bytes + file name + extra field
+        afile.seek(info.header_offset+26)
+        name_len, extra_len = np.frombuffer(afile.read(4), dtype='<u2')
+        afile.seek(info.header_offset+30+int(name_len)+int(extra_len))
+        shape, fortran, dtype = _readNpyHeader(afile)
+        offset = afile.tell()
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran else 'C')
+
+class FPArraySource:
+    """
+    Column source for numpy files:
+    + .npy: a single column (named after the file) or a structured array (one column per field)
+    + .npz: one column per array, uncompressed archives are memory-mapped
+    Columns are never copied as a whole: var and cut are evaluated element-wise on blocks of chunkSize
+    rows and the histogram is filled in bulk. The class mimics the TTree interface used by FPPlot.makeHistogramFromTTree.
+    """
+
+    def __init__(self, path, chunk_size=1000000):
+        self.path      = path
+        self.chunkSize = int(chunk_size)
+        self.columns   = {}
+        self.lengths   = {}
+
+        if path[-4:] == '.npz':
+            with zipfile.ZipFile(path) as zfile:
+                for info in zfile.infolist():
+                    if info.filename[-4:] == '.npy':
+                        name = info.filename[:-4]
+                        self.columns[name] = _mapNpzMember(path, zfile, info)
+                        if self.columns[name] is None:
+                            #---only the header of compressed members is decompressed
+                            with zfile.open(info) as member:
+                                shape = _readNpyHeader(member)[0]
+                            self.lengths[name] = shape[0] if len(shape) else 1
+            #---compressed members are decompressed on first use only
+            self.archive = np.load(path) if any(column is None for column in self.columns.values()) else None
+        else:
+            array = np.load(path, mmap_mode='r')
+            if array.dtype.names:
+                for field in array.dtype.names:
+                    self.columns[field] = array[field]
+            else:
+                self.columns[os.path.basename(path)[:-4]] = array
+
+    def GetName(self):
+        """Same name as a TTree created with the default constructor"""
+
+        return ""
+
+    def ClassName(self):
+        return "FPArraySource"
+
+    def GetEntries(self):
+        """
+        Number of rows (shortest column), read from the array headers without loading compressed columns
+        """
+
+        return min(self.lengths[name] if self.columns[name] is None else len(self.columns[name]) for name in self.columns) \
+            if len(self.columns) else 0
+
+    def getColumn(self, name):
+        if self.columns[name] is None:
+            self.columns[name] = self.archive[name]
+
+        return self.columns[name]
+
+    ###---expression evaluation----------------------------------------
+    def evaluate(self, code, names, start, stop):
+        """
+        Evaluate a compiled expression on the rows [start, stop)
+        """
+
+        namespace = {'fp_logical_and' : np.logical_and, 'fp_logical_or' : np.logical_or, 'fp_logical_not' : np.logical_not}
+        for name in names:
+            if name in self.columns:
+                namespace[name] = self.getColumn(name)[start:stop]
+            elif name in _array_functions:
+                namespace[name] = _array_functions[name]
+            elif name not in namespace:
+                raise NameError("column "+name+" not found in "+self.path)
+        value = eval(code, namespace)
+
+        return np.broadcast_to(value, (stop-start,)) if np.ndim(value) == 0 else value
+
+    ###---TTree::Draw interface----------------------------------------
+    def Draw(self, varexp, selection="", option="", nentries=-1, firstentry=0):
+        """
+        Fill the histogram specified in varexp (var>>name) block by block. As for TTree::Draw
+        a boolean selection is a mask, a numeric selection is the weight of each row.
+        If the histogram is not booked a TH1F/TH2F is created on the full range of the values.
+        Returns the number of selected rows.
+        """
+
+        var, name = varexp.split(">>") if ">>" in varexp else (varexp, "htemp")
+        name = name.lstrip("+")
+        variables = [compileExpression(expr) for expr in splitVarExpression(var)][::-1]
+        cut = compileExpression(selection) if selection.strip() != "" else None
+        first = int(firstentry)
+        last = self.GetEntries() if nentries < 0 else min(self.GetEntries(), first+int(nentries))
+
+        histo = ROOT.gDirectory.Get(name)
+        if not histo:
+            histo = self.bookHistogram(name, variables, cut, first, last)
+        selected = 0
+        for start in range(first, last, self.chunkSize):
+            stop = min(last, start+self.chunkSize)
+            weights = self.evaluate(*cut, start, stop) if cut else np.ones(stop-start)
+            mask = weights != 0
+            if not mask.any():
+                continue
+            values = [np.ascontiguousarray(self.evaluate(*variable, start, stop)[mask], dtype=np.float64) for variable in variables]
+            weights = np.ascontiguousarray(weights[mask], dtype=np.float64)
+            self.fill(histo, values, weights)
+            selected += len(weights)
+
+        return selected
+
+    def bookHistogram(self, name, variables, cut, first, last):
+        """
+        Create a histogram with the TTree::Draw default binning (100 bins in 1D, 40x40 in 2D) on the range of the selected values.
+        As for TTree::Draw the range is slightly enlarged so that the minimum and the maximum values are not under/overflows.
+        """
+
+        ranges = [[np.inf, -np.inf] for variable in variables]
+        for start in range(first, last, self.chunkSize):
+            stop = min(last, start+self.chunkSize)
+            mask = self.evaluate(*cut, start, stop) != 0 if cut else np.ones(stop-start, dtype=bool)
+            for irange, variable in enumerate(variables):
+                values = self.evaluate(*variable, start, stop)[mask]
+                if len(values):
+                    ranges[irange] = [min(ranges[irange][0], values.min()), max(ranges[irange][1], values.max())]
+        ranges = [vrange if vrange[0] <= vrange[1] else [0., 1.] for vrange in ranges]
+        ranges = [[vrange[0], vrange[1]+1.] if vrange[0] == vrange[1] else vrange for vrange in ranges]
+        ranges = [[vrange[0]-0.01*(vrange[1]-vrange[0]), vrange[1]+0.01*(vrange[1]-vrange[0])] for vrange in ranges]
+        if len(variables) == 1:
+            return ROOT.TH1F(name, name, 100, float(ranges[0][0]), float(ranges[0][1]))
+
+        return ROOT.TH2F(name, name, 40, float(ranges[0][0]), float(ranges[0][1]), 40, float(ranges[1][0]), float(ranges[1][1]))
+
+    def fill(self, histo, values, weights):
+        """
+        Fill histo in bulk: FillN for 1D histograms, TH2 and TProfile, a compiled loop for the other types
+        """
+
+        global _array_filler
+        if len(values) == 1 or (len(values) == 2 and (histo.GetDimension() == 2 or histo.ClassName() == "TProfile")):
+            histo.FillN(len(weights), *values, weights)
+            return
+
+        if not _array_filler:
+            ROOT.gInterpreter.Declare("""
+            void fp_fill_arrays(TH1* h, Long64_t n, const Double_t* x, const Double_t* y, const Double_t* z, const Double_t* w)
+            {
+                for(Long64_t i=0; i<n; ++i)
+                {
+                    if(h->InheritsFrom("TProfile2D"))
+                        ((TProfile2D*)h)->Fill(x[i], y[i], z[i], w[i]);
+                    else
+                        ((TH3*)h)->Fill(x[i], y[i], z[i], w[i]);
+                }
+            }""")
+            _array_filler = ROOT.fp_fill_arrays
+        _array_filler(histo, len(weights), values[0], values[1], values[2], weights)
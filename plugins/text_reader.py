@@ -0,0 +1,135 @@
+import os
+import multiprocessing as mp
+import ROOT
+
+from file_manager import prefetchPaused
+
+###---shared state for the parallel parser (inherited by the forked workers)
+_text_source = None
+
+class FPTextSource:
+    """
+    Streaming reader for text/CSV sources.
+    The file is parsed in chunks of lines: each chunk is loaded into a temporary TTree (``TTree::ReadStream``)
+    and drawn into the booked histogram, the whole table is never held in memory.
+    The class mimics the TTree interface used by FPPlot.makeHistogramFromTTree.
+    """
+
+    def __init__(self, path, branch_desc='', chunk_size=100000, workers=1):
+        self.path       = path
+        self.chunkSize  = int(chunk_size)
+        self.workers    = int(workers)
+        self.delimiter  = ',' if path[-4:] == '.csv' else ' '
+        self.branchDesc = str(branch_desc)
+        self.dataStart  = 0
+
+        #---no descriptor specified: the first line of the file describes the branches
+        if self.branchDesc == '':
+            with open(path, 'rb') as tfile:
+                self.branchDesc = tfile.readline().decode().strip()
+                self.dataStart = tfile.tell()
+            if self.delimiter != ' ' and ':' not in self.branchDesc:
+                self.branchDesc = self.branchDesc.replace(self.delimiter, ':')
+
+    def GetName(self):
+        """Same name as a TTree created with the default constructor"""
+
+        return ""
+
+    def ClassName(self):
+        return "FPTextSource"
+
+    ###---chunk reader------------------------------------------------
+    def iterChunks(self, start, end):
+        """
+        Yield blocks of at most chunkSize lines, for the lines starting in the byte range [start, end)
+        """
+
+        with open(self.path, 'rb') as tfile:
+            #---align to the first line starting inside the range
+            if start > self.dataStart:
+                tfile.seek(start-1)
+                tfile.readline()
+            else:
+                tfile.seek(self.dataStart)
+            lines = []
+            while tfile.tell() < end:
+                line = tfile.readline()
+                if not line:
+                    break
+                lines.append(line.decode())
+                if len(lines) == self.chunkSize:
+                    yield ''.join(lines)
+                    lines = []
+            if len(lines):
+                yield ''.join(lines)
+
+    ###---fill histogram from a range of the file----------------------
+    def fillRange(self, varexp, selection, start, end, nentries=-1):
+        """
+        Draw the lines in the byte range [start, end) into the histogram specified in varexp.
+        Returns the number of selected rows.
+        """
+
+        var, name = varexp.split(">>") if ">>" in varexp else (varexp, "htemp")
+        name = name.lstrip("+")
+        selected = 0
+        for chunk in self.iterChunks(start, end):
+            tree = ROOT.TTree("fp_text_chunk", "")
+            tree.ReadStream(ROOT.std.istringstream(chunk), self.branchDesc, self.delimiter)
+            #---the histogram is created by the first chunk if it was not booked
+            append = "+" if ROOT.gDirectory.Get(name) else ""
+            ndraw = tree.GetEntries() if nentries < 0 else min(tree.GetEntries(), nentries)
+            if ndraw > 0:
+                selected += tree.Draw(var+">>"+append+name, selection, "goff", ndraw)
+            if nentries >= 0:
+                nentries -= ndraw
+            del tree
+            if nentries == 0:
+                break
+
+        return selected
+
+    ###---TTree::Draw interface----------------------------------------
+    def Draw(self, varexp, selection="", option="", nentries=-1, firstentry=0):
+        """
+        Fill the histogram specified in varexp (var>>name) chunk by chunk.
+        With workers > 1 and a booked histogram the file is split in byte ranges parsed
+        by parallel processes, the partial histograms are summed in file order.
+        """
+
+        size = os.path.getsize(self.path)
+        name = varexp.split(">>")[-1].lstrip("+") if ">>" in varexp else ""
+        histo = ROOT.gDirectory.Get(name) if name != "" else None
+        if self.workers < 2 or not histo or nentries >= 0:
+            return self.fillRange(varexp, selection, self.dataStart, size, nentries)
+
+        global _text_source
+        _text_source = self
+        step = (size-self.dataStart)//self.workers+1
+        ranges = [(varexp, selection, self.dataStart+i*step, min(size, self.dataStart+(i+1)*step), name)
+                  for i in range(self.workers)]
+        with prefetchPaused():
+            pool = mp.get_context('fork').Pool(self.workers)
+        results = pool.map(_fillRangeWorker, ranges)
+        pool.close()
+        pool.join()
+        selected = 0
+        for partial, nsel in results:
+            histo.Add(partial)
+            selected += nsel
+
+        return selected
+
+def _fillRangeWorker(args):
+    """
+    Fill an empty copy of the booked histogram with one byte range of the file (parallel parser)
+    """
+
+    varexp, selection, start, end, name = args
+    histo = ROOT.gDirectory.Get(name)
+    histo.Reset()
+    nsel = _text_source.fillRange(varexp, selection, start, end)
+    histo.SetDirectory(0)
+
+    return histo, nsel
@@ -1,10 +1,60 @@
+import os
 import ROOT
 import yoda
 import numpy as np
 
+###---parsed YODA files shared by all the sources and plots of the session
+_yoda_files = {}
+
+def getYODAIndex(file):
+    """
+    Return the dictionary of the objects stored in a yoda file.
+    Each file is parsed only once, the index is refreshed if the file is modified.
+
+    :param file: path to yoda file.
+    :type file: str
+    """
+
+    mtime = os.path.getmtime(file)
+    if file not in _yoda_files or _yoda_files[file][0] != mtime:
+        _yoda_files[file] = (mtime, yoda.read(file))
+
+    return _yoda_files[file][1]
+
+def _asDoubles(values):
+    """
+    Convert a sequence to a contiguous array of doubles (as expected by the ROOT bulk setters)
+    """
+
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+def _symErrors(errs):
+    """
+    Reduce (minus, plus) error pairs to symmetric errors
+    """
+
+    errs = np.asarray(errs, dtype=np.float64)
+
+    return errs.mean(axis=1) if errs.ndim == 2 else errs
+
+def _profileBin(yoda_bin):
+    """
+    Return mean and standard error of a profile bin (zero for empty bins)
+    """
+
+    try:
+        return yoda_bin.mean, yoda_bin.stdErr
+    except Exception:
+        return 0., 0.
+
 def readYODA(file=None, key=None):
     """
-    Read histogram from yoda file
+    Read histogram from yoda file. Supported types:
+
+    - Histo1D   -> TH1F (including underflow and overflow)
+    - Histo2D   -> TH2F
+    - Profile1D -> TH1F holding the mean and standard error of each bin
+    - Scatter2D -> TGraphAsymmErrors
 
     :param file: path to yoda file.
     :type args: str
@@ -16,24 +66,52 @@ def readYODA(file=None, key=None):
     if not file or not key:
         raise Exception("file and key are mandatory arguments, please specify both")
 
-    h_yoda = yoda.read(file)[key]
+    h_yoda = getYODAIndex(file)[key]
 
     if isinstance(h_yoda, yoda.Histo1D):
         #---ROOT histogram
-        h_root = ROOT.TH1F(key, "", len(h_yoda.xMins()), np.append(h_yoda.xMins(), h_yoda.xMaxs()[-1]))
-
-        #---fill visible bins
-        for i, v in enumerate(h_yoda.yVals()):
-            h_root.SetBinContent(i+1, v)
-            h_root.SetBinError(i+1, h_yoda.yErrs()[i])
-
-        #---fill overflow and underflow
-        h_root.SetBinContent(0, h_yoda.underflow.sumW)
-        h_root.SetBinError(0, h_yoda.underflow.errW)
-        h_root.SetBinContent(h_root.GetNbinsX()+1, h_yoda.overflow.sumW)
-        h_root.SetBinError(h_root.GetNbinsX()+1, h_yoda.overflow.errW)        
-            
+        h_root = ROOT.TH1F(key, "", len(h_yoda.xMins()), _asDoubles(np.append(h_yoda.xMins(), h_yoda.xMaxs()[-1])))
+
+        #---fill all bins at once: underflow, visible bins, overflow
+        h_root.SetContent(_asDoubles(np.concatenate(([h_yoda.underflow.sumW], h_yoda.yVals(), [h_yoda.overflow.sumW]))))
+        h_root.SetError(_asDoubles(np.concatenate(([h_yoda.underflow.errW], _symErrors(h_yoda.yErrs()), [h_yoda.overflow.errW]))))
+
+    elif isinstance(h_yoda, yoda.Histo2D):
+        bins = h_yoda.bins()
+        x_mins = np.array([yoda_bin.xMin for yoda_bin in bins])
+        x_maxs = np.array([yoda_bin.xMax for yoda_bin in bins])
+        y_mins = np.array([yoda_bin.yMin for yoda_bin in bins])
+        y_maxs = np.array([yoda_bin.yMax for yoda_bin in bins])
+        x_edges = np.unique(np.concatenate((x_mins, x_maxs)))
+        y_edges = np.unique(np.concatenate((y_mins, y_maxs)))
+        h_root = ROOT.TH2F(key, "", len(x_edges)-1, _asDoubles(x_edges), len(y_edges)-1, _asDoubles(y_edges))
+
+        #---global ROOT bin index of each yoda bin (independent of the yoda bin ordering)
+        x_idx = np.searchsorted(x_edges, (x_mins+x_maxs)/2., side='right')
+        y_idx = np.searchsorted(y_edges, (y_mins+y_maxs)/2., side='right')
+        global_idx = x_idx+(len(x_edges)+1)*y_idx
+        contents = np.zeros(h_root.GetSize())
+        errors = np.zeros(h_root.GetSize())
+        contents[global_idx] = [yoda_bin.height for yoda_bin in bins]
+        errors[global_idx] = [yoda_bin.heightErr for yoda_bin in bins]
+        h_root.SetContent(contents)
+        h_root.SetError(errors)
+
+    elif isinstance(h_yoda, yoda.Profile1D):
+        h_root = ROOT.TH1F(key, "", len(h_yoda.xMins()), _asDoubles(np.append(h_yoda.xMins(), h_yoda.xMaxs()[-1])))
+        values = np.array([_profileBin(yoda_bin) for yoda_bin in h_yoda.bins()]).reshape(-1, 2)
+        h_root.SetContent(_asDoubles(np.concatenate(([0.], values[:, 0], [0.]))))
+        h_root.SetError(_asDoubles(np.concatenate(([0.], values[:, 1], [0.]))))
+
+    elif isinstance(h_yoda, yoda.Scatter2D):
+        x_errs = np.asarray(h_yoda.xErrs(), dtype=np.float64).reshape(-1, 2)
+        y_errs = np.asarray(h_yoda.yErrs(), dtype=np.float64).reshape(-1, 2)
+        h_root = ROOT.TGraphAsymmErrors(len(h_yoda.xVals()), _asDoubles(h_yoda.xVals()), _asDoubles(h_yoda.yVals()),
+                                        _asDoubles(x_errs[:, 0]), _asDoubles(x_errs[:, 1]),
+                                        _asDoubles(y_errs[:, 0]), _asDoubles(y_errs[:, 1]))
+        h_root.SetName(key)
+
     else:
-        raise Exception("Histogram type not supported: only Histo1D are currently supported")
+        raise Exception("Histogram type not supported: only Histo1D, Histo2D, Profile1D and Scatter2D are currently supported")
 
     return h_root
@@ -0,0 +1,233 @@
+#!/bin/python
+
+import os
+import sys
+import json
+import time
+import ROOT
+
+from fp_utils import *
+
+###---run progress class----------------------------------------------
+class FPProgress:
+    """
+    Progress and throughput metrics of a run, updated by the plot loop, the tree fills and the writer stage:
+    + plots done/remaining and ETA (from the average time per plot)
+    + entries scanned and entries/s for each tree
+    + bytes read from ROOT files
+    + number of running write processes
+    The metrics are periodically written to a JSON file (.json) or an OpenMetrics text file (any other extension)
+    and optionally printed as a compact progress line.
+    """
+
+    def __init__(self, nplots, metrics_file="", interval=10., show_line=False):
+        self.nplots      = nplots
+        self.done        = 0
+        self.trees       = {}
+        self.writers     = 0
+        self.metricsFile = metrics_file
+        self.interval    = interval
+        self.showLine    = show_line
+        self.start       = time.time()
+        self.lastWrite   = 0.
+
+    ###---fill engine---------------------------------------------------
+    def recordFill(self, tree, entries, elapsed):
+        """
+        Record entries scanned from a tree (file:tree or source path) in elapsed seconds
+        """
+
+        stats = self.trees.setdefault(tree, [0, 0.])
+        stats[0] += entries
+        stats[1] += elapsed
+        self.update()
+
+    ###---plot loop and writer stage-----------------------------------
+    def plotDone(self, write_procs):
+        self.done += 1
+        self.writers = sum(1 for proc in write_procs if proc.is_alive())
+        if self.showLine:
+            printMessage(self.getLine(), 0)
+        self.update(force=self.done == self.nplots)
+
+    def getMetrics(self):
+        elapsed = time.time()-self.start
+        eta = elapsed/self.done*(self.nplots-self.done) if self.done else -1.
+
+        return {'plots_done'         : self.done,
+                'plots_remaining'    : self.nplots-self.done,
+                'elapsed_seconds'    : elapsed,
+                'eta_seconds'        : eta,
+                'bytes_read'         : ROOT.TFile.GetFileBytesRead(),
+                'writer_queue_depth' : self.writers,
+                'trees'              : {tree : {'entries' : stats[0], 'entries_per_second' : stats[0]/stats[1] if stats[1] > 0 else 0.}
+                                        for tree, stats in self.trees.items()}}
+
+    def getLine(self):
+        """
+        Compact progress line: [done/total] entries/s, MB read, running writers, ETA
+        """
+
+        metrics = self.getMetrics()
+        entries = sum(stats[0] for stats in self.trees.values())
+        fill_time = sum(stats[1] for stats in self.trees.values())
+        eta = time.strftime("%H:%M:%S", time.gmtime(metrics['eta_seconds'])) if metrics['eta_seconds'] >= 0 else "--:--:--"
+
+        return "[%d/%d] %.3g entries/s, %.1f MB read, %d writers, ETA %s" % \
+            (self.done, self.nplots, entries/fill_time if fill_time > 0 else 0., metrics['bytes_read']/1e6, self.writers, eta)
+
+    ###---metrics file--------------------------------------------------
+    def update(self, force=False):
+        """
+        Rewrite the metrics file if the update interval has elapsed (atomic replace)
+        """
+
+        if self.metricsFile == "" or (not force and time.time()-self.lastWrite < self.interval):
+            return
+        self.lastWrite = time.time()
+        metrics = self.getMetrics()
+        tmp_path = self.metricsFile+".tmp"
+        with open(tmp_path, 'w') as mfile:
+            if self.metricsFile[-5:] == ".json":
+                json.dump(metrics, mfile, indent=1)
+            else:
+                mfile.write(self.getOpenMetrics(metrics))
+        os.replace(tmp_path, self.metricsFile)
+
+    def getOpenMetrics(self, metrics):
+        lines = []
+        for name, mtype in [('plots_done', 'gauge'), ('plots_remaining', 'gauge'), ('elapsed_seconds', 'gauge'),
+                            ('eta_seconds', 'gauge'), ('bytes_read', 'gauge'), ('writer_queue_depth', 'gauge')]:
+            lines.append("# TYPE fp_%s %s" % (name, mtype))
+            lines.append("fp_%s %g" % (name, metrics[name]))
+        for name in ['entries', 'entries_per_second']:
+            lines.append("# TYPE fp_tree_%s gauge" % name)
+            for tree, stats in metrics['trees'].items():
+                lines.append('fp_tree_%s{tree="%s"} %g' % (name, tree.replace('\\', '\\\\').replace('"', '\\"'), stats[name]))
+        lines.append("# EOF")
+
+        return "\n".join(lines)+"\n"
+
+###---completed plots journal-----------------------------------------
+class FPJournal:
+    """
+    Journal of the completed plots (outDir/fp_journal.jsonl): a plot is recorded once all its write
+    processes have terminated successfully and its output files are on disk. Each record holds the
+    hash of the resolved configuration, plots drawn with a different configuration are never considered completed.
+    """
+
+    def __init__(self, out_dir, cfg_key):
+        self.path    = os.path.join(out_dir, "fp_journal.jsonl")
+        self.cfgKey  = cfg_key
+        self.done    = {}
+        self.pending = []
+        if os.path.isfile(self.path):
+            with open(self.path) as jfile:
+                for line in jfile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        #---last line of a run killed while writing
+                        continue
+                    if record.get('cfg', None) == self.cfgKey:
+                        self.done[record['plot']] = record['files']
+
+    def isDone(self, plot_name):
+        """
+        Check if a plot has been completed with the same configuration and its outputs are unchanged on disk
+        """
+
+        if plot_name not in self.done:
+            return False
+
+        return all(os.path.isfile(path) and os.path.getsize(path) == size for path, size in self.done[plot_name].items())
+
+    ###---record plots--------------------------------------------------
+    def track(self, plot_name, procs, files):
+        self.pending.append((plot_name, procs, files))
+        self.update()
+
+    def update(self):
+        """
+        Record the plots whose write processes have all terminated
+        """
+
+        running = []
+        for plot_name, procs, files in self.pending:
+            if any(proc.is_alive() for proc in procs):
+                running.append((plot_name, procs, files))
+            elif all(proc.exitcode == 0 for proc in procs) and all(os.path.isfile(path) for path in files):
+                record = {'plot' : plot_name, 'cfg' : self.cfgKey, 'time' : time.time(),
+                          'files' : {path : os.path.getsize(path) for path in files}}
+                with open(self.path, 'a') as jfile:
+                    jfile.write(json.dumps(record)+"\n")
+                    jfile.flush()
+                    os.fsync(jfile.fileno())
+            else:
+                printMessage("output of <"+colors.CYAN+plot_name+colors.DEFAULT+"> not written", -1)
+        self.pending = running
+
+###---memory instrumentation------------------------------------------
+class FPMemoryReport:
+    """
+    Opt-in memory instrumentation (draw.memoryReport): resident memory before and after each plot and after
+    each histogram, live objects in the session directory by class and bytes held by the bin arrays of each histogram.
+    The JSON report (top consumers first) is rewritten after each plot so that it is available after an OOM kill.
+    """
+
+    def __init__(self, path, ntop=10, interval=5.):
+        self.path       = path
+        self.ntop       = ntop
+        self.interval   = interval
+        self.plots      = []
+        self.histos     = []
+        self.lastWrite  = 0.
+        self.current    = ""
+
+    ###---records------------------------------------------------------
+    def startPlot(self, plot_name):
+        self.current = plot_name
+        self.plots.append({'plot' : plot_name, 'rss_before' : getRSS()})
+        self.write()
+
+    def endPlot(self, plot, directory):
+        """
+        Record the plot memory and the objects alive in directory (by class) before the plot is released
+        """
+
+        objects = {}
+        for obj in directory.GetList():
+            objects[obj.ClassName()] = objects.get(obj.ClassName(), 0)+1
+        self.plots[-1].update({'rss_after' : getRSS(), 'objects' : objects,
+                               'histos_bytes' : sum(getObjectBytes(obj) for obj in plot.histos.values())})
+
+    def releasedPlot(self):
+        self.plots[-1]['rss_after_release'] = getRSS()
+        self.current = ""
+        self.write()
+
+    def recordHistogram(self, histo_key, obj, rss_before):
+        self.histos.append({'plot' : self.current, 'histo' : histo_key, 'class' : obj.ClassName() if obj else "",
+                            'rss_before' : rss_before, 'rss_after' : getRSS(), 'bytes' : getObjectBytes(obj) if obj else 0})
+        if time.time()-self.lastWrite > self.interval:
+            self.write()
+
+    ###---report-------------------------------------------------------
+    def getReport(self):
+        def delta(record):
+            return record.get('rss_after', getRSS())-record['rss_before']
+
+        return {'peak_rss'             : max([getRSS()]+[record.get('rss_after', 0) for record in self.plots]),
+                'current_plot'         : self.current,
+                'top_plots'            : sorted(self.plots, key=delta, reverse=True)[:self.ntop],
+                'top_histograms_rss'   : sorted(self.histos, key=delta, reverse=True)[:self.ntop],
+                'top_histograms_bytes' : sorted(self.histos, key=lambda record: record['bytes'], reverse=True)[:self.ntop],
+                'plots'                : self.plots,
+                'histograms'           : self.histos}
+
+    def write(self):
+        self.lastWrite = time.time()
+        tmp_path = self.path+".tmp"
+        with open(tmp_path, 'w') as rfile:
+            json.dump(self.getReport(), rfile, indent=1)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#---the FP modules are imported from the repository root, as draw.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,32 @@
+import pytest
+
+ROOT = pytest.importorskip("ROOT")
+np = pytest.importorskip("numpy")
+array_reader = pytest.importorskip("plugins.array_reader")
+
+def test_auto_booking_keeps_extremes(tmp_path):
+    """
+    Rows equal to the minimum and to the maximum are inside the auto-booked histogram
+    """
+
+    path = str(tmp_path/"values.npz")
+    np.savez(path, x=np.array([0., 1., 2., 3., 3., 3.]), y=np.array([5., 5., 6., 7., 8., 8.]))
+    source = array_reader.FPArraySource(path)
+
+    selected = source.Draw("x>>fp_test_auto_1d")
+    histo = ROOT.gDirectory.Get("fp_test_auto_1d")
+    assert selected == 6
+    assert histo.Integral() == selected
+
+    selected = source.Draw("y:x>>fp_test_auto_2d", "x > 0")
+    histo = ROOT.gDirectory.Get("fp_test_auto_2d")
+    assert selected == 5
+    assert histo.Integral() == selected
+
+def test_entries_from_compressed_headers(tmp_path):
+    path = str(tmp_path/"compressed.npz")
+    np.savez_compressed(path, x=np.arange(10.), y=np.arange(7.))
+    source = array_reader.FPArraySource(path)
+
+    assert source.GetEntries() == 7
+    assert all(column is None for column in source.columns.values())
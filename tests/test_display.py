@@ -0,0 +1,31 @@
+import pytest
+
+ROOT = pytest.importorskip("ROOT")
+fp_utils = pytest.importorskip("fp_utils")
+
+def test_rebin_for_display():
+    histo = ROOT.TH2F("fp_test_display", "", 4000, 0., 1., 10, 0., 1.)
+    histo.SetDirectory(0)
+    reduced = fp_utils.rebinForDisplay(histo, 1000, 1000)
+
+    assert reduced.GetNbinsX() == 1000
+    assert reduced.GetNbinsY() == 10
+
+def test_rebin_for_display_prime_bins():
+    """
+    An axis with a prime number of bins is left untouched instead of being merged into a single bin
+    """
+
+    histo = ROOT.TH2F("fp_test_display_prime", "", 4001, 0., 1., 4000, 0., 1.)
+    histo.SetDirectory(0)
+    histo.Fill(0.5, 0.5)
+    reduced = fp_utils.rebinForDisplay(histo, 1000, 1000)
+
+    assert reduced.GetNbinsX() == 4001
+    assert reduced.GetNbinsY() == 1000
+
+def test_rebin_for_display_prime_bins_only():
+    histo = ROOT.TH2F("fp_test_display_prime_only", "", 1009, 0., 1., 10, 0., 1.)
+    histo.SetDirectory(0)
+
+    assert fp_utils.rebinForDisplay(histo, 100, 100) is None
@@ -0,0 +1,45 @@
+import pytest
+
+ROOT = pytest.importorskip("ROOT")
+np = pytest.importorskip("numpy")
+plot_manager = pytest.importorskip("plot_manager")
+
+def makeVectorTree(nentries, nvalues):
+    """
+    Tree with a std::vector<double> branch holding nvalues values per entry
+    """
+
+    tree = ROOT.TTree("fp_test_vector", "")
+    tree.SetDirectory(0)
+    values = ROOT.std.vector('double')()
+    tree.Branch("values", values)
+    for entry in range(nentries):
+        values.clear()
+        for ivalue in range(nvalues):
+            values.push_back(ivalue+0.5)
+        tree.Fill()
+
+    return tree
+
+def test_sparse_fill_vector_branch():
+    """
+    Array branches select more values than entries: all of them are filled, none is read past the buffers
+    """
+
+    tree = makeVectorTree(nentries=10, nvalues=5)
+    sparse = ROOT.THnSparseF("fp_test_sparse", "", 2, np.array([5, 5], dtype=np.int32),
+                             np.array([0., 0.]), np.array([5., 5.]))
+    plot_manager.fillSparseFromTree(sparse, tree, "values:values", "", chunk_size=3)
+    projection = plot_manager.projectSparse(sparse, "x", "fp_test_projection")
+
+    assert projection.Integral() == 50
+    for ibin in range(1, 6):
+        assert projection.GetBinContent(ibin) == 10
+
+def test_sparse_fill_max_entries():
+    tree = makeVectorTree(nentries=10, nvalues=5)
+    sparse = ROOT.THnSparseF("fp_test_sparse_max", "", 2, np.array([5, 5], dtype=np.int32),
+                             np.array([0., 0.]), np.array([5., 5.]))
+    plot_manager.fillSparseFromTree(sparse, tree, "values:values", "", chunk_size=3, max_entries=4)
+
+    assert plot_manager.projectSparse(sparse, "x", "fp_test_projection_max").Integral() == 20